@@ -0,0 +1,128 @@
+import argparse
+import os
+import time
+from card_engine import CardEngine, CHIP_OPTIONS, MAX_SHORT_READ_LENGTH, is_atmel
+from card_simulator import SimulatedReader, make_card
+
+
+def simulated_engine(chip_type, latency=0.0, extended_apdu=False, **card_options):
+    """Returns an engine connected to a fresh simulated card, plus the reader for counting transmits."""
+    reader = SimulatedReader(card=make_card(chip_type, **card_options), latency=latency, extended_apdu=extended_apdu)
+    connection = reader.createConnection()
+    connection.connect()
+    engine = CardEngine(connection)
+    engine.prepare(chip_type)
+    return engine, reader
+
+
+def timed(reader, operation):
+    startCount = reader.transmit_count
+    start = time.perf_counter()
+    result = operation()
+    return result, reader.transmit_count - startCount, time.perf_counter() - start
+
+
+def bench_full_dump(latency=0.0):
+    """Full-card dump of every AT24Cxx: page-sized reads vs. 255-byte reads vs. extended-length reads."""
+    rows = []
+    for chip_type, (memorySize, pageSize) in CHIP_OPTIONS.items():
+        if not is_atmel(chip_type):
+            continue
+        row = {'chip': chip_type, 'bytes': memorySize}
+        pageRead = min(pageSize, MAX_SHORT_READ_LENGTH)
+        for mode, extended, chunkLength in (('page', False, pageRead), ('short', False, None), ('extended', True, None)):
+            engine, reader = simulated_engine(chip_type, latency, extended_apdu=extended)
+            engine.supports_extended_apdu()  # Keep the one-off probe out of the measurement
+            result, transmits, elapsed = timed(reader, lambda: engine.read(chip_type, 0, memorySize, chunkLength))
+            if not result.success:
+                raise RuntimeError(f'{chip_type} {mode} dump failed: {result.message}')
+            row[mode] = (transmits, elapsed)
+        rows.append(row)
+    return rows
+
+
+def best_of(repeat, operation):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        operation()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_image_buffers(repeat=5, chip_type='AT24C1024'):
+    """Per-byte list/str handling vs. bytes/memoryview for a full card image (128 KB by default).
+
+    The card-side rows run the engine against a zero-latency simulated card, so
+    they measure only the Python overhead around the APDUs.
+    """
+    memorySize, pageSize = CHIP_OPTIONS[chip_type]
+    image = os.urandom(memorySize)
+    text = image.hex()[:memorySize]
+    chunks = [image[i:i + MAX_SHORT_READ_LENGTH] for i in range(0, memorySize, MAX_SHORT_READ_LENGTH)]
+    listChunks = [list(chunk) for chunk in chunks]
+
+    def assemble_list():
+        readData = []
+        for chunk in listChunks:
+            readData.extend(chunk)
+
+    def assemble_bytes():
+        readData = bytearray()
+        for chunk in chunks:
+            readData.extend(chunk)
+
+    def compare_list():
+        data, current = list(image), list(image)
+        for i in range(0, memorySize, pageSize):
+            current[i:i + pageSize] == data[i:i + pageSize]
+
+    def compare_view():
+        data, current = memoryview(image), memoryview(bytearray(image))
+        for i in range(0, memorySize, pageSize):
+            current[i:i + pageSize] == data[i:i + pageSize]
+
+    engine, reader = simulated_engine(chip_type, extended_apdu=False)
+    engine.write(chip_type, 0, image)
+    rows = [
+        ('assemble read chunks', best_of(repeat, assemble_list), best_of(repeat, assemble_bytes)),
+        ('compare pages', best_of(repeat, compare_list), best_of(repeat, compare_view)),
+        ('encode text', best_of(repeat, lambda: [ord(c) for c in text]), best_of(repeat, lambda: text.encode('utf-8'))),
+        ('decode text', best_of(repeat, lambda: ''.join([chr(byte) for byte in image])),
+         best_of(repeat, lambda: image.replace(b'\xff', b' ').decode('utf-8', errors='replace'))),
+        ('engine read_range', None, best_of(repeat, lambda: engine.read_range(chip_type, 0, memorySize, cached=False))),
+        ('engine delta write (no changes)', None,
+         best_of(repeat, lambda: engine.write(chip_type, 0, image, delta=True, current=image))),
+    ]
+    return memorySize, rows
+
+
+def print_image_buffers(memorySize, rows):
+    print(f'{memorySize // 1024} KB image handling (best time)')
+    print(f"{'operation':<34} {'list/str':>12} {'bytes':>12}")
+    for name, legacy, current in rows:
+        legacyCell = f'{legacy * 1000:9.2f} ms' if legacy is not None else f"{'-':>12}"
+        print(f'{name:<34} {legacyCell} {current * 1000:9.2f} ms')
+
+
+def print_full_dump(rows):
+    print('Full dump round trips (time)')
+    print(f"{'chip':<10} {'bytes':>7} {'page-sized':>18} {'short Le':>18} {'extended Le':>18}")
+    for row in rows:
+        cells = ' '.join(f'{row[mode][0]:>7} ({row[mode][1] * 1000:7.1f} ms)' for mode in ('page', 'short', 'extended'))
+        print(f"{row['chip']:<10} {row['bytes']:>7} {cells}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Card engine benchmarks against the simulated reader.')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per APDU')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per image buffer measurement')
+    args = parser.parse_args()
+    print_full_dump(bench_full_dump(args.latency))
+    print()
+    print_image_buffers(*bench_image_buffers(args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import threading
+
+CACHE_PAGE_SIZE = 32
+
+
+class CardImage:
+    """The known part of one card's memory, kept in CACHE_PAGE_SIZE pages."""
+
+    def __init__(self, pageSize=CACHE_PAGE_SIZE):
+        self.pageSize = pageSize
+        self.pages = {}
+
+    def page_range(self, address, length):
+        return range(address // self.pageSize, (address + length - 1) // self.pageSize + 1)
+
+    def get(self, address, length):
+        """Returns the bytes if every page they touch is known, otherwise None."""
+        data = self.known_prefix(address, length)
+        return data if length > 0 and len(data) == length else None
+
+    def known_prefix(self, address, length):
+        """Returns the bytes from address on that are known, stopping at the first unknown page."""
+        data = bytearray()
+        while len(data) < length:
+            position = address + len(data)
+            page = position // self.pageSize
+            if page not in self.pages:
+                break
+            start = position - page * self.pageSize
+            data += self.pages[page][start:start + length - len(data)]
+        return bytes(data)
+
+    def unknown_length(self, address, length):
+        """Returns how many bytes from address on have to come from the card before a known page."""
+        missing = 0
+        while missing < length:
+            position = address + missing
+            if position // self.pageSize in self.pages:
+                break
+            missing += self.pageSize - position % self.pageSize
+        return min(missing, length)
+
+    def store(self, address, data):
+        """Records bytes read from or written to the card.
+
+        Pages only become known once fully covered; bytes landing in a partially
+        known page just patch it if it is already cached.
+        """
+        data = bytes(data)
+        for page in self.page_range(address, len(data)):
+            pageStart = page * self.pageSize
+            start = max(address, pageStart)
+            end = min(address + len(data), pageStart + self.pageSize)
+            chunk = data[start - address:end - address]
+            if start == pageStart and end == pageStart + self.pageSize:
+                self.pages[page] = chunk
+            elif page in self.pages:
+                current = self.pages[page]
+                self.pages[page] = current[:start - pageStart] + chunk + current[end - pageStart:]
+
+    def forget(self, address, length):
+        for page in self.page_range(address, length):
+            self.pages.pop(page, None)
+
+
+class CardImageCache:
+    """Card images keyed by (reader name, ATR, card generation), dropped when the card leaves the reader."""
+
+    def __init__(self, pageSize=CACHE_PAGE_SIZE):
+        self.pageSize = pageSize
+        self.lock = threading.Lock()
+        self.images = {}
+        # Bytes served from memory instead of the card
+        self.hits = 0
+
+    def get(self, key, address, length):
+        with self.lock:
+            image = self.images.get(key)
+            data = image.get(address, length) if image is not None else None
+            if data is not None:
+                self.hits += length
+            return data
+
+    def known_prefix(self, key, address, length):
+        with self.lock:
+            image = self.images.get(key)
+            data = image.known_prefix(address, length) if image is not None else b''
+            self.hits += len(data)
+            return data
+
+    def unknown_length(self, key, address, length):
+        with self.lock:
+            image = self.images.get(key)
+            return image.unknown_length(address, length) if image is not None else length
+
+    def store(self, key, address, data):
+        with self.lock:
+            image = self.images.setdefault(key, CardImage(self.pageSize))
+            image.store(address, data)
+
+    def forget(self, key, address, length):
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                image.forget(address, length)
+
+    def invalidate(self, reader_name=None):
+        """Drops every image for the reader (all readers if None); used as a pool listener."""
+        with self.lock:
+            for key in list(self.images):
+                if reader_name is None or key[0] == reader_name:
+                    del self.images[key]
@@ -0,0 +1,248 @@
+import argparse
+import json
+import sys
+import time
+from card_engine import CHIP_OPTIONS, CardEngine, CardResult, is_atmel
+from card_connection import ReaderConnectionPool
+from card_image import dump_image, restore_image
+from card_payload import PayloadError, encode_payload, encode_raw
+from card_save import read_json_data
+from card_simulator import SimulatedCardError, install_from_environment
+from card_trace import ApduTracer
+
+
+def card_errors():
+    """Exceptions reported as a JSON error: bad input, and anything the reader or card can raise."""
+    errors = (OSError, ValueError, PayloadError, SimulatedCardError)
+    try:
+        from smartcard.Exceptions import SmartcardException
+        from smartcard.pcsc.PCSCExceptions import BaseSCardException
+    except ImportError:
+        return errors
+    # CardConnectionException, NoCardException, ... and the PC/SC context and reader listing failures
+    return errors + (SmartcardException, BaseSCardException)
+
+
+def open_card(args):
+    """Connects to the requested reader (the first one by default) and selects the chip type."""
+    pool = ReaderConnectionPool()
+    readerNames = pool.reader_names()
+    readerName = args.reader or (readerNames[0] if readerNames else None)
+    if readerName is None:
+        return CardResult(False, None, 'No readers attached.')
+    engine = CardEngine(psc_file=args.psc_file, tracer=args.tracer)
+    result = pool.ensure_selected(readerName, args.chip, engine)
+    if not result.success:
+        return result
+    return CardResult(True, (engine, pool, readerName), result.message)
+
+
+def card_range(args):
+    memorySize, _ = CHIP_OPTIONS[args.chip]
+    if args.offset < 0 or args.offset >= memorySize:
+        raise ValueError(f'Offset must be between 0 and {memorySize - 1} for {args.chip}.')
+    length = memorySize - args.offset if args.length is None else args.length
+    return args.offset, min(length, memorySize - args.offset)
+
+
+def load_input(args):
+    """Returns the bytes to write for write-file/verify, encoding user_data JSON as a card payload."""
+    if args.format == 'json':
+        return encode_payload(read_json_data(args.input), compress=not args.no_compress)
+    with open(args.input, 'rb') as file:
+        data = file.read()
+    return encode_raw(data) if args.format == 'framed' else data
+
+
+def run_dump(engine, args):
+    if args.output and args.offset == 0 and args.length is None:
+        # A whole-card dump to a file is an image: streamed through mmap and resumable
+        result = dump_image(engine, args.chip, args.output, resume=not args.restart)
+        return {'success': result.success, 'message': result.message, 'bytes': result.data, 'output': args.output}
+    offset, length = card_range(args)
+    result = engine.read_range(args.chip, offset, length, cached=False)
+    if not result.success:
+        return {'success': False, 'message': result.message, 'bytes': len(result.data or [])}
+    data = bytes(result.data)
+    output = {'success': True, 'message': result.message, 'offset': offset, 'bytes': len(data)}
+    if args.output:
+        with open(args.output, 'wb') as file:
+            file.write(data)
+        output['output'] = args.output
+    else:
+        output['hex'] = data.hex()
+    return output
+
+
+def run_write_file(engine, args):
+    offset, length = card_range(args)
+    data = load_input(args)
+    if len(data) > length:
+        return {'success': False, 'message': f'{len(data)} bytes do not fit in {length} bytes of card memory.'}
+    written = engine.write(args.chip, offset, data, length if args.fill else len(data), delta=not args.full,
+                           verify_pages=args.verify_pages)
+    output = {'success': written.success, 'message': written.message, 'offset': offset, 'bytes': len(data),
+              'stats': written.data}
+    if not written.success:
+        return output
+    if args.format == 'raw':
+        readBack = engine.read_range(args.chip, offset, len(data), cached=False)
+        output['success'] = readBack.success and bytes(readBack.data) == data
+        output['message'] = 'Read-back matches the file.' if output['success'] else 'Read-back does not match the file.'
+    else:
+        verified = engine.verify_crc(args.chip, offset, data)
+        output['success'] = verified.success
+        output['message'] = verified.message
+    return output
+
+
+def run_verify(engine, args):
+    offset, length = card_range(args)
+    if args.input is None or args.format != 'raw':
+        expected = load_input(args) if args.input else None
+        result = engine.verify_crc(args.chip, offset, expected)
+        return {'success': result.success, 'message': result.message, 'offset': offset, 'payload': result.data}
+    expected = load_input(args)
+    result = engine.read_range(args.chip, offset, len(expected), cached=False)
+    if not result.success:
+        return {'success': False, 'message': result.message, 'offset': offset}
+    mismatch = next((i for i, (a, b) in enumerate(zip(result.data, expected)) if a != b), None)
+    if mismatch is None and len(result.data) != len(expected):
+        mismatch = len(result.data)
+    if mismatch is None:
+        return {'success': True, 'message': 'Card matches the file.', 'offset': offset, 'bytes': len(expected)}
+    return {'success': False, 'message': f'First difference at address {offset + mismatch:X}.', 'offset': offset,
+            'bytes': len(expected)}
+
+
+def run_restore(engine, args):
+    result = restore_image(engine, args.chip, args.input, resume=not args.restart, delta=not args.full,
+                           verify_pages=args.verify_pages)
+    return {'success': result.success, 'message': result.message, 'stats': result.data}
+
+
+def run_erase(engine, args):
+    offset, length = card_range(args)
+    result = engine.write(args.chip, offset, b'', length, delta=not args.full, verify_pages=args.verify_pages)
+    return {'success': result.success, 'message': result.message, 'offset': offset, 'bytes': length,
+            'stats': result.data}
+
+
+def run_bench(engine, args):
+    offset, length = card_range(args)
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        result = engine.read_range(args.chip, offset, length, cached=False)
+        timings.append(time.perf_counter() - start)
+        if not result.success:
+            return {'success': False, 'message': result.message, 'seconds': timings}
+    best = min(timings)
+    return {'success': True, 'message': f'Read {length} bytes {args.repeat} times.', 'bytes': length,
+            'best_seconds': round(best, 6), 'mean_seconds': round(sum(timings) / len(timings), 6),
+            'bytes_per_second': round(length / best) if best > 0 else None,
+            'extended_apdu': engine.supports_extended_apdu() if is_atmel(args.chip) else False}
+
+
+def run_info(engine, args, pool, readerName):
+    memorySize, pageSize = CHIP_OPTIONS[args.chip]
+    output = {'success': True, 'message': 'Card selected.', 'readers': pool.reader_names(),
+              'atr': bytes(pool.current_atr(readerName) or []).hex(), 'memory_size': memorySize,
+              'page_size': pageSize}
+    if is_atmel(args.chip):
+        output['extended_apdu'] = engine.supports_extended_apdu()
+    else:
+        counter = engine.read_presentation_error_counter()
+        bits = engine.read_protection_bits()
+        output['error_counter'] = counter.data
+        output['protection_bits'] = bytes(bits.data).hex() if bits.success else None
+        output['success'] = counter.success and bits.success
+        if not output['success']:
+            output['message'] = bits.message if counter.success else counter.message
+    return output
+
+
+COMMANDS = {
+    'dump': run_dump,
+    'write-file': run_write_file,
+    'verify': run_verify,
+    'restore': run_restore,
+    'erase': run_erase,
+    'bench': run_bench,
+}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Read, write and verify memory cards without the GUI. '
+                                                 'Every command prints a JSON result.')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--reader', help='reader name (default: the first attached reader)')
+    common.add_argument('--chip', default='AT24C64', choices=list(CHIP_OPTIONS), help='chip type of the card')
+    common.add_argument('--offset', type=int, default=0, help='first card address')
+    common.add_argument('--length', type=int, help='number of bytes (default: to the end of the card)')
+    common.add_argument('--psc-file', default='psc.txt', help='file holding the SLE5542 PSC')
+    common.add_argument('--trace', metavar='JSONL', help='append every APDU to this file and add '
+                                                       'per-operation latency histograms to the result')
+    payload = argparse.ArgumentParser(add_help=False)
+    payload.add_argument('--format', choices=('raw', 'framed', 'json'), default='raw',
+                         help='raw bytes, raw bytes in a CRC-framed payload, or user_data JSON as a card payload')
+    payload.add_argument('--no-compress', action='store_true', help='store JSON payloads uncompressed')
+    writing = argparse.ArgumentParser(add_help=False)
+    writing.add_argument('--full', action='store_true', help='write every page instead of only the changed ones')
+    writing.add_argument('--verify-pages', action='store_true', help='read back every page right after writing it')
+
+    commands = parser.add_subparsers(dest='command', required=True)
+    dump = commands.add_parser('dump', parents=[common], help='read card memory')
+    dump.add_argument('-o', '--output', help='binary output file (default: hex in the JSON result); '
+                                             'a whole-card dump is resumable if interrupted')
+    dump.add_argument('--restart', action='store_true', help='ignore the progress of an interrupted dump')
+    restore = commands.add_parser('restore', parents=[common, writing], help='write a whole-card image back')
+    restore.add_argument('input', help='image file made by dump')
+    restore.add_argument('--restart', action='store_true', help='ignore the progress of an interrupted restore')
+    write = commands.add_parser('write-file', parents=[common, payload, writing], help='write a file to the card')
+    write.add_argument('input', help='file to write')
+    write.add_argument('--fill', action='store_true', help='pad the rest of the range with 0xFF')
+    verify = commands.add_parser('verify', parents=[common, payload], help='check a payload by CRC or compare a file')
+    verify.add_argument('input', nargs='?', help='file the card should hold (default: only check the CRC)')
+    commands.add_parser('erase', parents=[common, writing], help='fill card memory with 0xFF')
+    bench = commands.add_parser('bench', parents=[common], help='time uncached reads of card memory')
+    bench.add_argument('--repeat', type=int, default=3, help='number of timed reads')
+    commands.add_parser('info', parents=[common], help='show the reader, ATR and chip details')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    install_from_environment()
+    args.tracer = ApduTracer(args.trace) if args.trace else None
+    start = time.perf_counter()
+    pool = None
+    try:
+        opened = open_card(args)
+        if not opened.success:
+            output = {'success': False, 'message': opened.message}
+        else:
+            engine, pool, readerName = opened.data
+            connected = time.perf_counter()
+            if args.command == 'info':
+                output = run_info(engine, args, pool, readerName)
+            else:
+                output = COMMANDS[args.command](engine, args)
+            output['reader'] = readerName
+            output['connect_seconds'] = round(connected - start, 6)
+    except card_errors() as e:
+        output = {'success': False, 'message': f'{type(e).__name__}: {str(e)}'}
+    finally:
+        if pool is not None:
+            pool.close()
+    output = {'command': args.command, 'chip': args.chip, **output,
+              'seconds': round(time.perf_counter() - start, 6)}
+    if args.tracer is not None:
+        output['apdu'] = args.tracer.histograms()
+        args.tracer.close()
+    print(json.dumps(output, indent=4))
+    return 0 if output['success'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
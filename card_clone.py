@@ -0,0 +1,165 @@
+import argparse
+import json
+import os
+import threading
+import time
+import zlib
+from card_engine import CHIP_OPTIONS, CardEngine, CardResult
+from card_connection import ReaderConnectionPool
+from card_image import readable_size
+from card_monitor import CardMonitor
+from card_simulator import install_from_environment
+from card_station import ReaderStats
+from card_trace import trace_from_environment
+
+
+def load_master_image(path, chip_type):
+    """Reads a master image (e.g. from card_cli.py dump) once, clipped to what the chip can hold."""
+    memorySize, _ = CHIP_OPTIONS[chip_type]
+    if os.path.getsize(path) > memorySize:
+        raise ValueError(f'Image is {os.path.getsize(path)} bytes, but {chip_type} holds {memorySize}.')
+    with open(path, 'rb') as file:
+        image = file.read()
+    return image[:readable_size(chip_type)]
+
+
+class CloneStation:
+    """Writes one master image to every card inserted into any attached reader.
+
+    Each card only gets the pages that differ from the master, and is then read
+    back and checked against the master's CRC32. With count set the station stops
+    after that many cards were cloned; otherwise it runs until stop() is called.
+    """
+
+    def __init__(self, image, chip_type="AT24C64", count=None, verify_pages=False, pool=None, poll_interval=0.2,
+                 psc_file="psc.txt", log=print):
+        self.image = image
+        self.crc = zlib.crc32(image)
+        self.chip_type = chip_type
+        self.count = count
+        self.verify_pages = verify_pages
+        self.pool = pool or ReaderConnectionPool()
+        self.poll_interval = poll_interval
+        self.psc_file = psc_file
+        self.log = log
+        self.claimed = 0
+        self.cloned = 0
+        self.countLock = threading.Lock()
+        self.done = threading.Event()
+        self.results = []
+        self.stats = {}
+
+    def stop(self):
+        self.done.set()
+
+    def claim(self):
+        # Reserve a card slot so parallel readers never clone more than count cards
+        with self.countLock:
+            if self.count is not None and self.claimed >= self.count:
+                return False
+            self.claimed += 1
+            return True
+
+    def finish_card(self, reader_name, success, elapsed, result):
+        self.results.append({'reader': reader_name, 'success': success, 'seconds': round(elapsed, 3),
+                             'stats': result.data, 'message': result.message})
+        with self.countLock:
+            if success:
+                self.cloned += 1
+            else:
+                self.claimed -= 1
+            if self.count is not None and self.cloned >= self.count:
+                self.done.set()
+
+    def clone_card(self, engine, reader_name):
+        result = self.pool.ensure_selected(reader_name, self.chip_type, engine)
+        if not result.success:
+            return result
+        written = engine.write(self.chip_type, 0, self.image, len(self.image), delta=True,
+                               verify_pages=self.verify_pages)
+        if not written.success:
+            return CardResult(False, written.data, f'Failed to write image: {written.message}')
+        readBack = engine.read_range(self.chip_type, 0, len(self.image), cached=False)
+        if not readBack.success:
+            return CardResult(False, written.data, f'Failed to read back image: {readBack.message}')
+        crc = zlib.crc32(bytes(readBack.data))
+        if crc != self.crc:
+            return CardResult(False, written.data, f'CRC mismatch: card {crc:08X}, master {self.crc:08X}.')
+        return CardResult(True, written.data, f'CRC verified: {len(self.image)} bytes, CRC32 {crc:08X}.')
+
+    def run(self, reader_names=None):
+        """Clones cards until count is reached or stop() is called, and returns the per-reader statistics."""
+        reader_names = reader_names or self.pool.refresh_readers()
+        if not reader_names:
+            raise RuntimeError('No readers attached.')
+        monitor = CardMonitor(self.pool, self.poll_interval).start()
+        workers = []
+        for reader_name in reader_names:
+            self.stats[reader_name] = ReaderStats(reader_name)
+            worker = threading.Thread(target=self.worker, args=(reader_name,), name=f'clone-{reader_name}', daemon=True)
+            worker.start()
+            workers.append(worker)
+        try:
+            while not self.done.wait(self.poll_interval):
+                pass
+        except KeyboardInterrupt:
+            self.stop()
+        for worker in workers:
+            worker.join()
+        monitor.stop()
+        return [stats.as_dict() for stats in self.stats.values()]
+
+    def worker(self, reader_name):
+        engine = CardEngine(psc_file=self.psc_file)
+        stats = self.stats[reader_name]
+        usedGeneration = None
+        while not self.done.is_set():
+            generation = self.pool.wait_for_card(reader_name, usedGeneration, poll_interval=self.poll_interval,
+                                                 stop=self.done)
+            if generation is None or not self.claim():
+                return
+            usedGeneration = generation
+
+            started = time.monotonic()
+            try:
+                result = self.clone_card(engine, reader_name)
+            except Exception as e:
+                result = CardResult(False, None, f'Error cloning card: {str(e)}')
+            elapsed = time.monotonic() - started
+
+            if result.success:
+                stats.encoded += 1
+                stats.busy_seconds += elapsed
+                pagesWritten = result.data['pages_written']
+                self.log(f'[{reader_name}] Card cloned in {elapsed:.2f}s ({pagesWritten} pages written). '
+                         f'Please swap the card.')
+            else:
+                stats.failed += 1
+                self.log(f'[{reader_name}] Clone failed ({result.message}). Please swap the card.')
+            self.finish_card(reader_name, result.success, elapsed, result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write one master card image to every card inserted into any reader.')
+    parser.add_argument('image', help='master image file, e.g. from card_cli.py dump -o')
+    parser.add_argument('--chip', default='AT24C64', choices=list(CHIP_OPTIONS), help='chip type of the cards')
+    parser.add_argument('--count', type=int, help='stop after this many cards (default: run until interrupted)')
+    parser.add_argument('--verify-pages', action='store_true', help='read back every page right after writing it')
+    parser.add_argument('--psc-file', default='psc.txt', help='file holding the SLE5542 PSC')
+    args = parser.parse_args()
+
+    install_from_environment()
+    tracer = trace_from_environment()
+    station = CloneStation(load_master_image(args.image, args.chip), args.chip, args.count, args.verify_pages,
+                           psc_file=args.psc_file)
+    started = time.monotonic()
+    stats = station.run()
+    output = {'seconds': round(time.monotonic() - started, 3), 'cloned': station.cloned, 'readers': stats,
+              'cards': station.results}
+    if tracer is not None:
+        output['apdu'] = tracer.histograms()
+    print(json.dumps(output, indent=4))
+
+
+if __name__ == '__main__':
+    main()
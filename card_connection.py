@@ -0,0 +1,158 @@
+import threading
+import time
+from card_engine import CardEngine, CardResult, is_atmel, list_readers
+
+
+def card_type_code(chip_type):
+    # The 0xA4 select APDU only distinguishes the two card families
+    return 0x02 if is_atmel(chip_type) else 0x06
+
+
+class ReaderConnectionPool:
+    """Keeps one live connection per reader and remembers which card type was selected on it.
+
+    A connection is only re-established (and the card re-selected) when the card
+    was removed or swapped, which is detected through the ATR reported by the reader.
+    """
+
+    def __init__(self, readers_func=None):
+        self.readers_func = readers_func or list_readers
+        self.lock = threading.RLock()
+        self.readers = {}
+        self.connections = {}
+        self.atrs = {}
+        self.selected = {}
+        self.listeners = []
+        # Bumped on every fresh connection, so a reseated card is noticed even if its ATR is identical
+        self.generations = {}
+        # Set by a running CardMonitor: lets waiters skip readers it knows are empty and wake on its events
+        self.presence = None
+        self.cardChanged = threading.Condition(self.lock)
+
+    def refresh_readers(self):
+        with self.lock:
+            self.readers = {str(reader): reader for reader in self.readers_func()}
+            # Drop connections to readers that were unplugged
+            for name in list(self.connections):
+                if name not in self.readers:
+                    self.invalidate(name)
+            return list(self.readers)
+
+    def reader_names(self):
+        with self.lock:
+            if not self.readers:
+                self.refresh_readers()
+            return list(self.readers)
+
+    def add_listener(self, listener):
+        """Registers listener(reader_name) to be called whenever a reader's card is removed or swapped."""
+        self.listeners.append(listener)
+
+    def invalidate(self, reader_name):
+        with self.lock:
+            connection = self.connections.pop(reader_name, None)
+            self.atrs.pop(reader_name, None)
+            self.selected.pop(reader_name, None)
+            if connection is not None:
+                try:
+                    connection.disconnect()
+                except Exception:
+                    pass
+        for listener in self.listeners:
+            listener(reader_name)
+        self.notify_card_change()
+
+    def notify_card_change(self):
+        with self.cardChanged:
+            self.cardChanged.notify_all()
+
+    def current_atr(self, reader_name):
+        with self.lock:
+            return self.atrs.get(reader_name)
+
+    def get(self, reader_name):
+        """Returns a live connection to the reader, reconnecting only if the card changed."""
+        with self.lock:
+            connection = self.connections.get(reader_name)
+            if connection is not None:
+                try:
+                    atr = connection.getATR()
+                except Exception:
+                    atr = None
+                if atr and atr == self.atrs.get(reader_name):
+                    return connection
+                self.invalidate(reader_name)
+
+            reader = self.readers.get(reader_name)
+            if reader is None:
+                self.refresh_readers()
+                reader = self.readers.get(reader_name)
+                if reader is None:
+                    return None
+            connection = reader.createConnection()
+            connection.connect()
+            self.connections[reader_name] = connection
+            self.atrs[reader_name] = connection.getATR()
+            self.generations[reader_name] = self.generations.get(reader_name, 0) + 1
+            return connection
+
+    def card_generation(self, reader_name):
+        with self.lock:
+            return self.generations.get(reader_name, 0)
+
+    def wait_for_card(self, reader_name, after_generation=None, timeout=None, poll_interval=0.2, stop=None):
+        """Blocks until a card is present, and newer than after_generation if given.
+
+        Returns the card's generation, or None on timeout or when the stop event is set.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while stop is None or not stop.is_set():
+            if self.presence is not None and self.presence.present(reader_name) is None:
+                connection = None  # The monitor knows the reader is empty, so there is nothing to ask it
+            else:
+                try:
+                    connection = self.get(reader_name)
+                except Exception:
+                    connection = None
+            if connection is not None:
+                generation = self.card_generation(reader_name)
+                if after_generation is None or generation != after_generation:
+                    return generation
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            # Card monitor events end the wait early
+            with self.cardChanged:
+                self.cardChanged.wait(poll_interval)
+        return None
+
+    def connect(self, reader_name):
+        try:
+            connection = self.get(reader_name)
+        except Exception as e:
+            return CardResult(False, None, f'Error connecting to reader: {str(e)}')
+        if connection is None:
+            return CardResult(False, None, 'Selected reader not found')
+        return CardResult(True, connection, f'Connected to reader: {reader_name}')
+
+    def ensure_selected(self, reader_name, chip_type, engine=None):
+        """Connects to the reader and sends the 0xA4 select only if that card type is not already selected."""
+        with self.lock:
+            result = self.connect(reader_name)
+            if not result.success:
+                return result
+            engine = engine or CardEngine()
+            engine.connection = result.data
+            # Cached card images are only valid for this exact card insertion
+            engine.cache_key = (reader_name, tuple(self.atrs[reader_name]), self.generations[reader_name])
+            code = card_type_code(chip_type)
+            if self.selected.get(reader_name) == code:
+                return CardResult(True, result.data, 'Card type already selected.')
+            result = engine.prepare(chip_type)
+            if result.success:
+                self.selected[reader_name] = code
+            return CardResult(result.success, engine.connection, result.message)
+
+    def close(self):
+        with self.lock:
+            for name in list(self.connections):
+                self.invalidate(name)
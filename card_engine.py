@@ -0,0 +1,709 @@
+import threading
+import time
+import zlib
+from collections import namedtuple
+from card_payload import HEADER_SIZE, PayloadError, parse_header
+
+# Memory size and page size (in bytes) for every supported chip
+CHIP_OPTIONS = {
+    "AT24C01": (128, 8),
+    "AT24C02": (256, 8),
+    "AT24C04": (512, 16),
+    "AT24C08": (1024, 16),
+    "AT24C16": (2048, 16),
+    "AT24C32": (4096, 32),
+    "AT24C64": (8192, 32),
+    "AT24C128": (16384, 64),
+    "AT24C256": (32768, 64),
+    "AT24C512": (65536, 128),
+    "AT24C1024": (131072, 256),
+    "SLE5542": (256, 1)
+}
+
+SLE5542_MEMORY_SIZE = 256
+SLE5542_PROTECTED_BYTES = 32
+
+# The reader is switched to 32-byte pages by select_page_size, so a single
+# AT24Cxx write APDU never carries more than this
+MAX_ATMEL_WRITE_LENGTH = 32
+
+# SLE5542 memory has no pages: one update APDU carries as many bytes as a short Lc allows
+MAX_SLE5542_WRITE_LENGTH = 255
+# Unchanged bytes shorter than this between two changed runs are rewritten
+# rather than paying for another APDU header
+SLE5542_MERGE_GAP = 5
+
+# EEPROM reads have no page boundary, so they are sized by what the reader
+# accepts: a short APDU carries up to 255 bytes of Le, an extended one more
+MAX_SHORT_READ_LENGTH = 255
+MAX_EXTENDED_READ_LENGTH = 65535
+
+# P1 P2 only address 64 KB: on AT24C1024 the 17th address bit selects the bank
+# through the low bit of INS (B0/B1 read, D0/D1 write), as ACS readers expect
+ATMEL_BANK_SIZE = 0x10000
+ATMEL_MAX_ADDRESS = 2 * ATMEL_BANK_SIZE
+
+DEFAULT_PSC = [0xFF, 0xFF, 0xFF]
+
+# Status words a reader reports for conditions that clear up on their own
+# (execution error, EEPROM still busy with the previous write, memory failure)
+TRANSIENT_STATUS_WORDS = {(0x64, 0x00), (0x65, 0x00), (0x65, 0x81), (0x6F, 0x00)}
+# Presenting or changing the PSC twice can burn a second error counter bit, and
+# protection bits are permanent, so these are never re-sent
+NON_RETRYABLE_INS = {0x20, 0xD1, 0xD2}
+# Reads whose short Le can be corrected after a 6Cxx
+READ_INS = {0xB0, 0xB1, 0xB2}
+
+CardResult = namedtuple('CardResult', ['success', 'data', 'message'])
+
+
+class RetryPolicy:
+    """Bounded exponential backoff for APDUs that raised or returned a transient status word."""
+
+    def __init__(self, max_attempts=4, base_delay=0.02, max_delay=0.5, transient_status_words=TRANSIENT_STATUS_WORDS,
+                 sleep=time.sleep):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.transient_status_words = transient_status_words
+        self.sleep = sleep
+        self.retries = 0
+
+    def is_transient(self, sw1, sw2):
+        return (sw1, sw2) in self.transient_status_words
+
+    def should_retry(self, command, attempt, idempotent=None):
+        if idempotent is None:
+            idempotent = len(command) > 1 and command[1] not in NON_RETRYABLE_INS
+        return attempt < self.max_attempts and idempotent
+
+    def wait(self, attempt):
+        self.retries += 1
+        self.sleep(min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+def is_atmel(chip_type):
+    return chip_type.startswith('AT24')
+
+
+def atmel_header(ins, address):
+    """Returns CLA INS P1 P2 addressing an AT24Cxx byte, with bit 16 of the address in the low bit of INS."""
+    return [0xFF, ins | (address >> 16), (address >> 8) & 0xFF, address & 0xFF]
+
+
+# Replacement for smartcard.System.readers, e.g. the in-process simulator
+readers_backend = None
+
+
+def set_readers_backend(readers_func):
+    """Routes reader discovery through readers_func instead of PC/SC (None restores PC/SC)."""
+    global readers_backend
+    readers_backend = readers_func
+
+
+# Tracer given to engines created without one, e.g. an ApduTracer from card_trace
+default_tracer = None
+
+
+def set_default_tracer(tracer):
+    """Traces the APDUs of every engine created from now on (None turns tracing off)."""
+    global default_tracer
+    default_tracer = tracer
+
+
+def list_readers():
+    if readers_backend is not None:
+        return readers_backend()
+    from smartcard.System import readers
+    return readers()
+
+
+def find_reader(reader_name=None):
+    """Returns the reader with the given name, or the first attached reader if no name is given."""
+    availableReaders = list_readers()
+    if reader_name is None:
+        return availableReaders[0] if availableReaders else None
+    return next((r for r in availableReaders if str(r) == reader_name), None)
+
+
+def open_connection(reader_name=None):
+    reader = find_reader(reader_name)
+    if reader is None:
+        return None
+    connection = reader.createConnection()
+    connection.connect()
+    return connection
+
+
+def read_psc_from_file(filename="psc.txt"):
+    """Reads the PSC from the file, returning it together with a warning message (None if the file was used)."""
+    try:
+        with open(filename, "r") as file:
+            # Read the PSC, strip whitespace and spaces, then parse
+            psc_hex = file.readline().strip().replace(" ", "")
+            return [int(psc_hex[i:i+2], 16) for i in range(0, len(psc_hex), 2)], None
+    except FileNotFoundError:
+        return list(DEFAULT_PSC), 'PSC file not found, using default PSC.'
+    except ValueError as e:
+        return list(DEFAULT_PSC), f'Error parsing PSC: {str(e)}'
+
+
+def write_psc_to_file(psc, filename="psc.txt"):
+    psc_hex = ''.join([f"{byte:02X}" for byte in psc])
+    with open(filename, "w") as file:
+        file.write(psc_hex)
+
+
+class CardEngine:
+    """GUI-free card I/O: every operation returns a CardResult instead of writing to a widget."""
+
+    def __init__(self, connection=None, psc_file="psc.txt", extended_apdu=None,
+                 max_extended_read_length=MAX_EXTENDED_READ_LENGTH, tracer=None, retry_policy=None):
+        self.connection = connection
+        # RetryPolicy(max_attempts=1) turns retries off
+        self.retry_policy = retry_policy or RetryPolicy()
+        # tracer.record(reader_name, command, data, sw1, sw2, seconds, error) is called for every APDU
+        self.tracer = tracer or default_tracer
+        self.psc_file = psc_file
+        self.memorySize = SLE5542_MEMORY_SIZE
+        # None means probe each reader once for extended-length APDU support
+        self.extended_apdu = extended_apdu
+        self.max_extended_read_length = max_extended_read_length
+        self.extended_support = {}
+        self.lock = threading.RLock()
+        # Optional CardImageCache; cache_key identifies the inserted card and is set by the connection pool
+        self.cache = None
+        self.cache_key = None
+        # The PSC is read from psc_file once; psc_session names the card insertion it was verified on
+        self.psc = None
+        self.psc_session = None
+        # (psc session, set of protected addresses) from the last protection bits read
+        self.protection = None
+
+    def connect(self, reader_name=None):
+        try:
+            self.connection = open_connection(reader_name)
+        except Exception as e:
+            self.connection = None
+            return CardResult(False, None, f'Error connecting to reader: {str(e)}')
+        if self.connection is None:
+            return CardResult(False, None, 'Selected reader not found')
+        return CardResult(True, self.connection, f'Connected to reader: {reader_name or self.connection.getReader()}')
+
+    def transmit(self, command, idempotent=None):
+        # The GUI thread and the card I/O worker may share one engine.
+        # idempotent overrides the retry decision NON_RETRYABLE_INS makes from the INS byte.
+        with self.lock:
+            command = list(command)
+            attempt = 1
+            while True:
+                try:
+                    data, sw1, sw2 = self.send(command)
+                except Exception:
+                    if not self.retry_policy.should_retry(command, attempt, idempotent):
+                        raise
+                else:
+                    wrongLength = sw1 == 0x6C and command[1] in READ_INS and len(command) == 5
+                    if wrongLength and attempt < self.retry_policy.max_attempts:
+                        # Wrong Le: the card told us the right one, so re-issue at once
+                        command = command[:4] + [sw2]
+                        attempt += 1
+                        continue
+                    transient = self.retry_policy.is_transient(sw1, sw2)
+                    if not (transient and self.retry_policy.should_retry(command, attempt, idempotent)):
+                        return data, sw1, sw2
+                self.retry_policy.wait(attempt)
+                attempt += 1
+
+    def send(self, command):
+        with self.lock:
+            if self.tracer is None:
+                return self.connection.transmit(command)
+            start = time.perf_counter()
+            try:
+                data, sw1, sw2 = self.connection.transmit(command)
+            except Exception as e:
+                self.tracer.record(self.reader_name(), command, None, None, None, time.perf_counter() - start, str(e))
+                raise
+            self.tracer.record(self.reader_name(), command, data, sw1, sw2, time.perf_counter() - start)
+            return data, sw1, sw2
+
+    def reader_name(self):
+        try:
+            return str(self.connection.getReader())
+        except Exception:
+            return None
+
+    def select_card_type(self, chip_type):
+        cardType = 0x02 if is_atmel(chip_type) else 0x06
+        try:
+            command = [0xFF, 0xA4, 0x00, 0x00, 0x01, cardType]  # Command for selecting card type
+            data, sw1, sw2 = self.transmit(command)
+            if (sw1, sw2) == (0x90, 0x00):
+                return CardResult(True, None, 'Card type selected successfully.')
+            return CardResult(False, None, f'Select card type failed with SW1 SW2 = {sw1:02X} {sw2:02X}')
+        except Exception as e:
+            return CardResult(False, None, f'Error selecting card type: {str(e)}')
+
+    def select_page_size(self):
+        command = [0xFF, 0x01, 0x00, 0x00, 0x01, 0x05]  # Command to select 32-byte page size
+        try:
+            data, sw1, sw2 = self.transmit(command)
+        except Exception as e:
+            return CardResult(False, None, f'Error selecting page size: {str(e)}')
+        if (sw1, sw2) == (0x90, 0x00):
+            return CardResult(True, None, 'Page size selected successfully.')
+        return CardResult(False, None, f"Error selecting page size with SW1 SW2 = {sw1:02X} {sw2:02X}")
+
+    def cached(self, address, length):
+        if self.cache is None or self.cache_key is None:
+            return None
+        return self.cache.get(self.cache_key, address, length)
+
+    def remember(self, address, data):
+        if self.cache is not None and self.cache_key is not None:
+            self.cache.store(self.cache_key, address, data)
+
+    def prepare(self, chip_type):
+        """Selects the card type (and page size for AT24Cxx) ahead of a read or write."""
+        result = self.select_card_type(chip_type)
+        if result.success and is_atmel(chip_type):
+            self.select_page_size()
+        return result
+
+    def read_atmel(self, address, length, cached=True):
+        # Make sure address and length are within valid range
+        if address < 0 or length <= 0:
+            return CardResult(False, None, 'Error: Address and length must be positive numbers.')
+        if address + length > ATMEL_MAX_ADDRESS:
+            return CardResult(False, None, f'Error: Read past the {ATMEL_MAX_ADDRESS} byte address space.')
+        data = self.cached(address, length) if cached else None
+        if data is not None:
+            return CardResult(True, data, f'Read from cache: Addr: {address:X}, Length: {length + 1}')
+        bankEnd = address - address % ATMEL_BANK_SIZE + ATMEL_BANK_SIZE
+        if address + length > bankEnd:
+            # One APDU only addresses one bank, so a read across the boundary takes two
+            first = self.read_atmel(address, bankEnd - address, cached=False)
+            if not first.success:
+                return first
+            second = self.read_atmel(bankEnd, address + length - bankEnd, cached=False)
+            if not second.success:
+                return second
+            return CardResult(True, first.data + second.data, second.message)
+        if length > MAX_SHORT_READ_LENGTH:
+            # Extended Le: a zero byte followed by the length on two bytes
+            le = [0x00, length >> 8, length & 0xFF]
+        else:
+            le = [length]
+        try:
+            command = atmel_header(0xB0, address) + le
+            data, sw1, sw2 = self.transmit(command)
+        except Exception as e:
+            return CardResult(False, None, f'Exception during read: {str(e)}')
+        if (sw1, sw2) == (0x90, 0x00):
+            data = bytes(data)
+            self.remember(address, data)
+            return CardResult(True, data, f'Read Successful: Addr: {address:X}, Length: {length + 1}')
+        return CardResult(False, None, f"Error reading memory with SW1 SW2 = {sw1:02X} {sw2:02X}")
+
+    def write_atmel(self, address, dataToWrite, pageSize=MAX_ATMEL_WRITE_LENGTH):
+        # pageSize is the chip's EEPROM page: a write running past its end wraps to the start of the page
+        # Check if dataToWrite is valid
+        if not dataToWrite:
+            return CardResult(False, None, 'Error: Data to write is null.')
+        if len(dataToWrite) > MAX_ATMEL_WRITE_LENGTH:
+            return CardResult(False, None, 'Error: Data length exceeds page size.')
+        lastAddress = address + len(dataToWrite) - 1
+        if address // ATMEL_BANK_SIZE != lastAddress // ATMEL_BANK_SIZE or lastAddress >= ATMEL_MAX_ADDRESS:
+            return CardResult(False, None, 'Error: Data crosses a 64 KB bank boundary.')
+        try:
+            command = atmel_header(0xD0, address) + [len(dataToWrite)] + list(dataToWrite)
+            # Rewriting an EEPROM page is harmless, even though D1 is the SLE5542 protect INS
+            _, sw1, sw2 = self.transmit(command, idempotent=True)
+        except Exception as e:
+            return CardResult(False, None, f'Error writing data: {str(e)}')
+        if (sw1, sw2) == (0x90, 0x00):
+            if address % pageSize + len(dataToWrite) > pageSize:
+                # The bytes did not land where they were addressed, so drop the pages instead of recording them
+                pageStart = address - address % pageSize
+                if self.cache is not None and self.cache_key is not None:
+                    self.cache.forget(self.cache_key, pageStart, address + len(dataToWrite) - pageStart)
+            else:
+                self.remember(address, dataToWrite)
+            return CardResult(True, len(dataToWrite), 'Data written successfully')
+        return CardResult(False, None, f'Failed to write data with SW1 SW2 = {sw1:02X} {sw2:02X}')
+
+    def read_memory(self, address, length, cached=True):
+        if address + length > self.memorySize - 1 or address < 0 or length <= 0:
+            return CardResult(False, None, 'Address or length out of bounds')
+        data = self.cached(address, length) if cached else None
+        if data is not None:
+            return CardResult(True, data, 'Data read from cache')
+        try:
+            command = [0xFF, 0xB0, 0x00, address, length]
+            data, sw1, sw2 = self.transmit(command)
+        except Exception as e:
+            return CardResult(False, None, f'Error reading data: {str(e)}')
+        if (sw1, sw2) == (0x90, 0x00):
+            data = bytes(data)
+            self.remember(address, data)
+            return CardResult(True, data, 'Data read successfully')
+        return CardResult(False, None, f'Failed to read data with SW1 SW2 = {sw1:02X} {sw2:02X}')
+
+    def write_memory(self, address, dataToWrite):
+        if address + len(dataToWrite) > self.memorySize - 1 or address < 0:
+            return CardResult(False, None, 'Address or data length out of bounds')
+        resumed = self.psc_session is not None and self.psc_session == self.current_psc_session()
+        verify = self.ensure_psc_verified()
+        if not verify.success:
+            return CardResult(False, None, f'PSC verification failed. Cannot perform write operation. {verify.message}')
+        try:
+            command = [0xFF, 0xD0, 0x00, address, len(dataToWrite)] + list(dataToWrite)
+            _, sw1, sw2 = self.transmit(command)
+            if (sw1, sw2) != (0x90, 0x00) and resumed:
+                # The card may have lost the verified state (e.g. it was reset), so verify again once
+                self.end_psc_session()
+                verify = self.verify_psc()
+                if not verify.success:
+                    return CardResult(False, None, f'PSC verification failed. Cannot perform write operation. {verify.message}')
+                _, sw1, sw2 = self.transmit(command)
+        except Exception as e:
+            self.end_psc_session()
+            return CardResult(False, None, f'Error writing data: {str(e)}')
+        if (sw1, sw2) == (0x90, 0x00):
+            if address < SLE5542_PROTECTED_BYTES and self.cache is not None and self.cache_key is not None:
+                # Protected bytes silently keep their old value, so the written data cannot be trusted there
+                self.cache.forget(self.cache_key, address, len(dataToWrite))
+            else:
+                self.remember(address, dataToWrite)
+            return CardResult(True, len(dataToWrite), 'Data written successfully')
+        return CardResult(False, None, f'Failed to write data with SW1 SW2 = {sw1:02X} {sw2:02X}')
+
+    def load_psc(self):
+        if self.psc is None:
+            self.psc, message = read_psc_from_file(self.psc_file)
+        return self.psc
+
+    def current_psc_session(self):
+        # A reseated card gets a new connection (and cache key) from the pool
+        return (id(self.connection), self.cache_key)
+
+    def end_psc_session(self):
+        self.psc_session = None
+
+    def ensure_psc_verified(self):
+        """Verifies the PSC only if it has not been verified since the card was inserted."""
+        if self.psc_session is not None and self.psc_session == self.current_psc_session():
+            return CardResult(True, 0x07, 'PSC already verified.')
+        return self.verify_psc()
+
+    def verify_psc(self, psc=None):
+        self.end_psc_session()
+        if psc is None:
+            psc = self.load_psc()
+        try:
+            # Construct the command to submit the PSC
+            command = [0xFF, 0x20, 0x00, 0x00, 0x03] + list(psc)
+            data, sw1, sw2 = self.transmit(command)
+        except Exception as e:
+            return CardResult(False, None, f'Error during PSC verification: {str(e)}')
+        # Interpret the response based on SW2
+        if sw1 != 0x90:
+            return CardResult(False, None, f'Failed to verify PSC with SW1 SW2 = {sw1:02X} {sw2:02X}')
+        if sw2 == 0x07:  # Verification is correct
+            self.psc = list(psc)
+            self.psc_session = self.current_psc_session()
+            return CardResult(True, sw2, 'PSC verified.')
+        if sw2 == 0x00:  # Password is locked
+            return CardResult(False, sw2, 'PSC verification failed: password is locked.')
+        # Other values indicate failed verification attempts
+        return CardResult(False, sw2, f'PSC verification failed: current error count is {sw2}.')
+
+    def change_secret_code(self, new_psc):
+        verify = self.verify_psc()
+        if not verify.success:
+            return CardResult(False, None, 'Current PSC verification required before changing the code.')
+        command = [0xFF, 0xD2, 0x00, 0x01, 0x03] + list(new_psc)
+        data, sw1, sw2 = self.transmit(command)
+        if (sw1, sw2) == (0x90, 0x00):
+            write_psc_to_file(new_psc, self.psc_file)
+            self.psc = list(new_psc)
+            return CardResult(True, None, 'Secret code changed successfully.')
+        return CardResult(False, None, 'Failed to change secret code.')
+
+    def read_protection_bits(self):
+        try:
+            command = [0xFF, 0xB2, 0x00, 0x00, 0x04]  # Command to read protection bits
+            data, sw1, sw2 = self.transmit(command)
+        except Exception as e:
+            return CardResult(False, None, f'Error reading protection bits: {str(e)}')
+        if (sw1, sw2) == (0x90, 0x00):
+            # PROT 1 to PROT 4 are the first 4 bytes
+            return CardResult(True, data[:4], 'Protection bits read successfully.')
+        return CardResult(False, None, f'Failed to read protection bits with SW1 SW2 = {sw1:02X} {sw2:02X}')
+
+    def protected_addresses(self):
+        """Returns the addresses whose protection bit is cleared, read once per card insertion."""
+        session = self.current_psc_session()
+        if self.protection is None or self.protection[0] != session:
+            result = self.read_protection_bits()
+            if not result.success:
+                return result
+            protected = {address for address in range(SLE5542_PROTECTED_BYTES)
+                         if not result.data[address // 8] & (1 << (address % 8))}
+            self.protection = (session, protected)
+        return CardResult(True, self.protection[1], 'Protection bits read successfully.')
+
+    def read_presentation_error_counter(self):
+        command = [0xFF, 0xB1, 0x00, 0x00, 0x04]
+        data, sw1, sw2 = self.transmit(command)
+        if (sw1, sw2) == (0x90, 0x00) and len(data) > 0:
+            return CardResult(True, data[0], f'Presentation error counter: {data[0]}')
+        return CardResult(False, None, 'Failed to read presentation error counter.')
+
+    def supports_extended_apdu(self):
+        if self.extended_apdu is not None:
+            return self.extended_apdu
+        readerName = self.reader_name()
+        if readerName not in self.extended_support:
+            # Probe with an extended read the reader could not express as a short APDU. It must reach
+            # the reader: the card image cache would answer it even if the reader cannot.
+            result = self.read_atmel(0, MAX_SHORT_READ_LENGTH + 1, cached=False)
+            self.extended_support[readerName] = result.success and len(result.data) == MAX_SHORT_READ_LENGTH + 1
+        return self.extended_support[readerName]
+
+    def max_read_length(self, chip_type):
+        if is_atmel(chip_type) and self.supports_extended_apdu():
+            return self.max_extended_read_length
+        return MAX_SHORT_READ_LENGTH
+
+    def read(self, chip_type, byteOffset, dataLength, chunkLength=None, progress=None, cancel=None):
+        """Reads dataLength bytes starting at byteOffset, as the basic view's Read Data does."""
+        memorySize, pageSize = CHIP_OPTIONS[chip_type]
+        if byteOffset + dataLength > memorySize:
+            dataLength = memorySize - byteOffset
+        if chip_type == 'SLE5542':
+            dataLength = dataLength - 1
+        return self.read_range(chip_type, byteOffset, dataLength, chunkLength, progress, cancel)
+
+    def read_range(self, chip_type, byteOffset, dataLength, chunkLength=None, progress=None, cancel=None,
+                   cached=True):
+        """Reads exactly dataLength bytes (clipped to the card) using the largest reads the reader supports.
+
+        Pages already in the card image cache are served from memory unless cached
+        is False. progress(done, total) is called after every APDU; setting the
+        cancel event stops the read before the next one.
+        """
+        memorySize, pageSize = CHIP_OPTIONS[chip_type]
+        if chip_type == 'SLE5542':
+            memorySize = memorySize - 1  # read_memory never reaches the last byte
+        dataLength = min(dataLength, memorySize - byteOffset)
+        if chunkLength is None:
+            chunkLength = self.max_read_length(chip_type)
+
+        readData = bytearray()
+        totalReadBytes = 0
+        while totalReadBytes < dataLength:
+            if cancel is not None and cancel.is_set():
+                return CardResult(False, readData, 'Read cancelled.')
+            currentLength = min(chunkLength, dataLength - totalReadBytes)
+            if cached and self.cache is not None and self.cache_key is not None:
+                known = self.cache.known_prefix(self.cache_key, byteOffset + totalReadBytes, currentLength)
+                if known:
+                    readData.extend(known)
+                    totalReadBytes += len(known)
+                    continue
+                # Only fetch up to the next page the cache already holds
+                currentLength = self.cache.unknown_length(self.cache_key, byteOffset + totalReadBytes, currentLength)
+            if is_atmel(chip_type):
+                result = self.read_atmel(byteOffset + totalReadBytes, currentLength, cached=False)
+            else:
+                result = self.read_memory(byteOffset + totalReadBytes, currentLength, cached=False)
+            if not result.success or not result.data:
+                return CardResult(False, readData, f'Failed to read data: {result.message}')
+            readData.extend(result.data)
+            totalReadBytes += len(result.data)
+            if progress is not None:
+                progress(totalReadBytes, dataLength)
+        # Chunks rarely line up with cache pages, so also record the range as a whole
+        self.remember(byteOffset, readData)
+        return CardResult(True, readData, 'Data read successfully.')
+
+    def verify_crc(self, chip_type, byteOffset=0, expected=None, progress=None, cancel=None):
+        """Checks a framed payload on the card by reading only its header and body.
+
+        If expected (the framed bytes that were written) is given, the card must
+        also carry the same length and CRC.
+        """
+        header = self.read_range(chip_type, byteOffset, HEADER_SIZE, cached=False)
+        if not header.success:
+            return CardResult(False, None, f'Failed to read payload header: {header.message}')
+        try:
+            version, flags, length, crc = parse_header(header.data)
+        except PayloadError as e:
+            return CardResult(False, None, f'Verification failed: {str(e)}')
+        if expected is not None and bytes(expected[:HEADER_SIZE]) != header.data:
+            return CardResult(False, None, 'Verification failed: card holds a different payload header.')
+
+        body = self.read_range(chip_type, byteOffset + HEADER_SIZE, length, progress=progress, cancel=cancel,
+                               cached=False)
+        if not body.success or len(body.data) != length:
+            return CardResult(False, None, f'Failed to read payload: {body.message}')
+        if zlib.crc32(body.data) != crc:
+            return CardResult(False, None, 'Verification failed: payload CRC mismatch.')
+        return CardResult(True, {'length': length, 'crc': crc}, f'CRC verified: {length} bytes, CRC32 {crc:08X}.')
+
+    def write(self, chip_type, byteOffset, data, dataLength=None, delta=False, verify_pages=False,
+              current=None, progress=None, cancel=None, resume_offset=None):
+        """Writes data at byteOffset and fills the rest of dataLength bytes with 0xFF.
+
+        With delta=True the current contents are read in bulk first (or taken from
+        current, if the caller already read them) and only the pages that differ
+        from the target image are written. With verify_pages=True every page is
+        read back right after it is written, so a bad page stops the write
+        immediately. progress(done, total) and the cancel event work as in read_range.
+
+        If a page still fails after the engine's retries, the stats carry
+        'resume_offset'; passing it back as resume_offset continues the same
+        write from that page instead of from byteOffset.
+        """
+        memorySize, pageSize = CHIP_OPTIONS[chip_type]
+        if byteOffset >= memorySize:
+            return CardResult(False, None, 'Error: Byte offset exceeds chip memory size.')
+        if dataLength is None or byteOffset + dataLength > memorySize or dataLength < 0:
+            dataLength = memorySize - byteOffset  # Adjust dataLength to not exceed memorySize
+        if chip_type == 'SLE5542':
+            # read_memory/write_memory never touch the last byte of the card
+            dataLength = min(dataLength, memorySize - 1 - byteOffset)
+        if len(data) > memorySize - byteOffset:
+            return CardResult(False, None, 'Error: Data does not fit in chip memory.')
+        # Pages are sliced out of one buffer without copying
+        data = memoryview(bytes(data))
+        # Fill the rest of the specified length with FF, if applicable
+        fill = memoryview(b'\xFF' * max(dataLength - len(data), 0))
+
+        if not delta:
+            current = None
+        elif current is None:
+            # A failed or short read just leaves the unread pages marked dirty
+            current = self.read_range(chip_type, byteOffset, len(data) + len(fill), cancel=cancel).data
+        if current is not None:
+            current = memoryview(bytes(current))
+
+        # Everything before resume_offset was already written by an earlier, interrupted call
+        skip = 0 if resume_offset is None else min(max(resume_offset - byteOffset, 0), len(data) + len(fill))
+        stats = {'bytes': skip, 'pages_written': 0, 'pages_skipped': 0, 'total': len(data) + len(fill)}
+        options = {'verify_pages': verify_pages, 'progress': progress, 'cancel': cancel}
+        if skip < len(data):
+            currentData = current[skip:] if current is not None else None
+            written = self._write_pages(chip_type, byteOffset + skip, data[skip:], pageSize, currentData, stats,
+                                        **options)
+            if not written.success:
+                return CardResult(False, stats, f'Failed to write data chunk: {written.message}')
+        stats['blank_pages_skipped'] = 0
+        fillSkip = max(skip - len(data), 0)
+        fill = fill[fillSkip:]
+        fillOffset = byteOffset + len(data) + fillSkip
+        if fill:
+            if current is not None:
+                currentFill = current[len(data) + fillSkip:]
+            else:
+                # Read the tail once so pages that are already erased are not padded again
+                tail = self.read_range(chip_type, fillOffset, len(fill), cancel=cancel)
+                currentFill = memoryview(tail.data)
+            skippedBefore = stats['pages_skipped']
+            filled = self._write_pages(chip_type, fillOffset, fill, pageSize, currentFill, stats, **options)
+            stats['blank_pages_skipped'] = stats['pages_skipped'] - skippedBefore
+            if not filled.success:
+                return CardResult(False, stats, f'Failed to fill remaining memory: {filled.message}')
+        return CardResult(True, stats, 'Data written successfully.')
+
+    def _write_pages(self, chip_type, address, data, pageSize, current, stats,
+                     verify_pages=False, progress=None, cancel=None):
+        if not is_atmel(chip_type):
+            return self._write_runs(chip_type, address, data, current, stats, verify_pages, progress, cancel)
+        # Chunks never cross a page boundary, so the EEPROM page buffer cannot wrap around
+        pageSize = min(pageSize, MAX_ATMEL_WRITE_LENGTH)
+        totalWrittenBytes = 0
+        while totalWrittenBytes < len(data):
+            if cancel is not None and cancel.is_set():
+                stats['resume_offset'] = address + totalWrittenBytes
+                return CardResult(False, stats, 'Write cancelled.')
+            start = address + totalWrittenBytes
+            chunkLength = min(pageSize - start % pageSize, len(data) - totalWrittenBytes)
+            chunkEnd = totalWrittenBytes + chunkLength
+            dataChunk = data[totalWrittenBytes:chunkEnd]
+            if current is not None and current[totalWrittenBytes:chunkEnd] == dataChunk:
+                stats['pages_skipped'] += 1
+            else:
+                result = self.write_atmel(start, dataChunk, pageSize)
+                if not result.success:
+                    stats['resume_offset'] = start
+                    return CardResult(False, stats, result.message)
+                if verify_pages:
+                    readBack = self.read_range(chip_type, start, chunkLength, cached=False)
+                    if readBack.data != dataChunk:
+                        stats['resume_offset'] = start
+                        return CardResult(False, stats, f'Verification failed for page at address {start:X}.')
+                stats['pages_written'] += 1
+            totalWrittenBytes = chunkEnd
+            stats['bytes'] += chunkLength
+            if progress is not None:
+                progress(stats['bytes'], stats['total'])
+        return CardResult(True, stats, 'Data written successfully')
+
+    def _write_runs(self, chip_type, address, data, current, stats, verify_pages=False, progress=None, cancel=None):
+        # SLE5542 pages are single bytes: changed bytes are grouped into runs of up
+        # to MAX_SLE5542_WRITE_LENGTH, split around bytes the protection bits lock
+        if address < SLE5542_PROTECTED_BYTES:
+            protection = self.protected_addresses()
+            if not protection.success:
+                return CardResult(False, stats, protection.message)
+            protected = protection.data
+        else:
+            protected = set()
+        stats.setdefault('protected_skipped', 0)
+        runs = []
+        for i, byte in enumerate(data):
+            if address + i in protected:
+                # The card silently keeps the old value, so there is nothing to send
+                stats['protected_skipped'] += 1
+                continue
+            if current is not None and i < len(current) and current[i] == byte:
+                stats['pages_skipped'] += 1
+                continue
+            if runs:
+                start, end = runs[-1]
+                gap = range(address + end, address + i)
+                if (i - end <= SLE5542_MERGE_GAP and i + 1 - start <= MAX_SLE5542_WRITE_LENGTH
+                        and not protected.intersection(gap)):
+                    # Rewriting the few unchanged bytes in between is cheaper than a new APDU
+                    stats['pages_skipped'] -= i - end
+                    runs[-1] = (start, i + 1)
+                    continue
+            runs.append((i, i + 1))
+
+        done = 0
+        for start, end in runs:
+            if cancel is not None and cancel.is_set():
+                stats['resume_offset'] = address + start
+                return CardResult(False, stats, 'Write cancelled.')
+            dataChunk = data[start:end]
+            result = self.write_memory(address + start, dataChunk)
+            if not result.success:
+                stats['resume_offset'] = address + start
+                return CardResult(False, stats, result.message)
+            if verify_pages:
+                readBack = self.read_range(chip_type, address + start, end - start, cached=False)
+                if readBack.data != dataChunk:
+                    stats['resume_offset'] = address + start
+                    return CardResult(False, stats, f'Verification failed for page at address {address + start:X}.')
+            stats['pages_written'] += end - start
+            stats['bytes'] += end - done
+            done = end
+            if progress is not None:
+                progress(stats['bytes'], stats['total'])
+        stats['bytes'] += len(data) - done
+        if progress is not None:
+            progress(stats['bytes'], stats['total'])
+        return CardResult(True, stats, 'Data written successfully')
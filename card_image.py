@@ -0,0 +1,198 @@
+import json
+import mmap
+import os
+from card_engine import CHIP_OPTIONS, CardResult, is_atmel
+
+# Progress is flushed to disk at least this often, so an interrupted dump or
+# restore loses at most this many bytes of work
+IMAGE_CHECKPOINT_BYTES = 4096
+# A resumed dump re-reads this many pages of what it already has (always
+# including the last one) to make sure the same card is still inserted
+IMAGE_RESUME_SAMPLES = 4
+# SLE5542 pages are single bytes, so samples are at least this long
+MIN_SAMPLE_BYTES = 16
+
+
+def checkpoint_path(path):
+    return path + '.progress'
+
+
+def card_identity(engine):
+    try:
+        return bytes(engine.connection.getATR()).hex()
+    except Exception:
+        return None
+
+
+def load_checkpoint(path, operation, chip_type, identity):
+    """Returns the address an interrupted operation on the same file and card got to, or 0."""
+    try:
+        with open(checkpoint_path(path), 'r') as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        return 0
+    if (state.get('operation'), state.get('chip'), state.get('card')) != (operation, chip_type, identity):
+        return 0
+    return state.get('done', 0)
+
+
+def save_checkpoint(path, operation, chip_type, identity, done):
+    temporary = checkpoint_path(path) + '.tmp'
+    with open(temporary, 'w') as file:
+        json.dump({'operation': operation, 'chip': chip_type, 'card': identity, 'done': done}, file)
+    os.replace(temporary, checkpoint_path(path))
+
+
+def clear_checkpoint(path):
+    try:
+        os.remove(checkpoint_path(path))
+    except FileNotFoundError:
+        pass
+
+
+def matching_prefix(engine, chip_type, image, done):
+    """Returns how much of the checkpointed image[:done] the card really holds, rounded down to a page.
+
+    Memory cards of one type share a generic ATR, so a checkpoint may belong to
+    another card; the prefix is read back before any of it is skipped.
+    """
+    if not done:
+        return 0
+    _, pageSize = CHIP_OPTIONS[chip_type]
+    readBack = engine.read_range(chip_type, 0, done, cached=False)
+    if not readBack.success:
+        return 0
+    card = bytes(readBack.data)
+    expected = bytes(image[:done])
+    if card == expected:
+        return done
+    mismatch = next((i for i, (a, b) in enumerate(zip(card, expected)) if a != b), min(len(card), done))
+    return mismatch - mismatch % pageSize
+
+
+def samples_match(engine, chip_type, image, done, samples=IMAGE_RESUME_SAMPLES):
+    """Checks a few pages of the checkpointed image[:done] against the card, the last one included.
+
+    Cheaper than matching_prefix: resuming a dump must cost less than starting
+    it over, and a different card with the same ATR almost never matches them all.
+    """
+    _, pageSize = CHIP_OPTIONS[chip_type]
+    sampleLength = min(max(pageSize, MIN_SAMPLE_BYTES), done)
+    last = done - sampleLength
+    offsets = {last - last % pageSize}
+    for i in range(samples - 1):
+        offset = last * i // max(samples - 1, 1)
+        offsets.add(offset - offset % pageSize)
+    for offset in sorted(offsets):
+        readBack = engine.read_range(chip_type, offset, sampleLength, cached=False)
+        if not readBack.success or bytes(readBack.data) != bytes(image[offset:offset + sampleLength]):
+            return False
+    return True
+
+
+def readable_size(chip_type):
+    memorySize, _ = CHIP_OPTIONS[chip_type]
+    # read_memory never reaches the last SLE5542 byte, so the image keeps 0xFF there
+    return memorySize if is_atmel(chip_type) else memorySize - 1
+
+
+def dump_image(engine, chip_type, path, resume=True, progress=None, cancel=None):
+    """Streams the whole card into a memory-mapped image file of the chip's memory size.
+
+    Each chunk goes straight from the APDU response into the mapping. If an
+    earlier dump of the same card into path was interrupted it continues from the
+    last checkpointed page, once a few sampled pages show the card is the same.
+    Returns a CardResult whose data is the number of bytes read.
+    """
+    memorySize, pageSize = CHIP_OPTIONS[chip_type]
+    identity = card_identity(engine)
+    start = load_checkpoint(path, 'dump', chip_type, identity) if resume else 0
+    if start and os.path.getsize(path) != memorySize:
+        start = 0
+    if start:
+        with open(path, 'rb') as file:
+            if not samples_match(engine, chip_type, file.read(start), start):
+                start = 0
+    if not start:
+        with open(path, 'wb') as file:
+            file.truncate(memorySize)
+    chunkLength = engine.max_read_length(chip_type)
+    if chunkLength >= pageSize:
+        # Chunks end on page boundaries, so a resumed dump restarts at a page
+        chunkLength -= chunkLength % pageSize
+    end = readable_size(chip_type)
+
+    with open(path, 'r+b') as file, mmap.mmap(file.fileno(), memorySize) as image:
+        if not start:
+            image[:] = b'\xFF' * memorySize
+        address = start
+        checkpointed = start
+        while address < end:
+            if cancel is not None and cancel.is_set():
+                image.flush()
+                save_checkpoint(path, 'dump', chip_type, identity, address)
+                return CardResult(False, address - start, 'Dump cancelled.')
+            length = min(chunkLength, end - address)
+            if is_atmel(chip_type):
+                result = engine.read_atmel(address, length)
+            else:
+                result = engine.read_memory(address, length)
+            if not result.success or not result.data:
+                image.flush()
+                save_checkpoint(path, 'dump', chip_type, identity, address)
+                return CardResult(False, address - start, f'Failed to read data at address {address:X}: {result.message}')
+            image[address:address + len(result.data)] = bytes(result.data)
+            address += len(result.data)
+            if address - checkpointed >= IMAGE_CHECKPOINT_BYTES:
+                image.flush()
+                save_checkpoint(path, 'dump', chip_type, identity, address)
+                checkpointed = address
+            if progress is not None:
+                progress(address, end)
+        image.flush()
+    clear_checkpoint(path)
+    message = f'Dumped {end} bytes to {path}' + (f' (resumed at {start:X}).' if start else '.')
+    return CardResult(True, end - start, message)
+
+
+def restore_image(engine, chip_type, path, resume=True, delta=True, verify_pages=False, progress=None, cancel=None):
+    """Writes a memory-mapped image file back to the card, one checkpointed window at a time.
+
+    With delta=True only pages that differ from the card are written. An
+    interrupted restore of the same file to the same card resumes at the last
+    checkpoint. Returns a CardResult whose data holds the combined write statistics.
+    """
+    memorySize, pageSize = CHIP_OPTIONS[chip_type]
+    if os.path.getsize(path) != memorySize:
+        return CardResult(False, None, f'Image is {os.path.getsize(path)} bytes, but {chip_type} holds {memorySize}.')
+    identity = card_identity(engine)
+    start = load_checkpoint(path, 'restore', chip_type, identity) if resume else 0
+    end = readable_size(chip_type)
+    window = max(IMAGE_CHECKPOINT_BYTES - IMAGE_CHECKPOINT_BYTES % pageSize, pageSize)
+    stats = {'bytes': 0, 'pages_written': 0, 'pages_skipped': 0, 'total': end - start}
+
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as image:
+        start = matching_prefix(engine, chip_type, image, start)
+        stats['total'] = end - start
+        address = start
+        while address < end:
+            if cancel is not None and cancel.is_set():
+                save_checkpoint(path, 'restore', chip_type, identity, address)
+                return CardResult(False, stats, 'Restore cancelled.')
+            windowEnd = min(address + window, end)
+            written = engine.write(chip_type, address, image[address:windowEnd], windowEnd - address, delta=delta,
+                                   verify_pages=verify_pages, cancel=cancel)
+            if written.data:
+                for key in ('pages_written', 'pages_skipped'):
+                    stats[key] += written.data[key]
+            if not written.success:
+                save_checkpoint(path, 'restore', chip_type, identity, address)
+                return CardResult(False, stats, f'Failed to restore window at address {address:X}: {written.message}')
+            stats['bytes'] += windowEnd - address
+            address = windowEnd
+            save_checkpoint(path, 'restore', chip_type, identity, address)
+            if progress is not None:
+                progress(stats['bytes'], stats['total'])
+    clear_checkpoint(path)
+    message = f'Restored {stats["bytes"]} bytes from {path}' + (f' (resumed at {start:X}).' if start else '.')
+    return CardResult(True, stats, message)
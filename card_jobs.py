@@ -0,0 +1,70 @@
+import itertools
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class CardJob:
+    """A card operation queued for the I/O thread, with its progress and cancellation state."""
+
+    def __init__(self, jobId, operation, args, kwargs, progress):
+        self.id = jobId
+        self.operation = operation
+        self.args = args
+        self.kwargs = kwargs
+        self.progressCallback = progress
+        self.cancelEvent = threading.Event()
+        self.future = Future()
+
+    def cancel(self):
+        # A job that has not started is dropped; a running one stops at the next APDU
+        if not self.future.cancel():
+            self.cancelEvent.set()
+
+    def cancelled(self):
+        return self.cancelEvent.is_set() or self.future.cancelled()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def report_progress(self, done, total):
+        if self.progressCallback is not None:
+            self.progressCallback(self, done, total)
+
+
+class CardJobQueue:
+    """Runs card operations one at a time on a dedicated I/O thread.
+
+    Operations are engine methods (or any callable) accepting progress and cancel
+    keyword arguments, such as CardEngine.read_range, write and verify_crc.
+    """
+
+    def __init__(self, name='card-io'):
+        self.jobs = queue.Queue()
+        self.jobIds = itertools.count(1)
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, operation, *args, progress=None, **kwargs):
+        job = CardJob(next(self.jobIds), operation, args, kwargs, progress)
+        self.jobs.put(job)
+        return job
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = job.operation(*job.args, progress=job.report_progress, cancel=job.cancelEvent, **job.kwargs)
+            except Exception as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+
+    def shutdown(self, wait=True):
+        self.jobs.put(None)
+        if wait:
+            self.thread.join()
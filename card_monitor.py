@@ -0,0 +1,138 @@
+import threading
+import card_engine
+
+
+class CardMonitor:
+    """Watches the attached readers and their cards in the background.
+
+    Keeps the last known ATR per reader, so callers can ask whether a card is
+    present without talking to the reader. On PC/SC the events come from
+    pyscard's card and reader monitors; with a replacement readers backend (the
+    simulator) or without pyscard the readers are polled through the pool
+    instead. listener(event, reader_name, atr) is called from the monitor thread
+    with event 'inserted', 'removed' or 'readers'.
+    """
+
+    def __init__(self, pool, poll_interval=0.5, use_pcsc=None):
+        self.pool = pool
+        self.poll_interval = poll_interval
+        if use_pcsc is None:
+            # PC/SC events only describe the real readers
+            use_pcsc = card_engine.readers_backend is None and pool.readers_func is card_engine.list_readers
+        self.use_pcsc = use_pcsc
+        self.lock = threading.Lock()
+        self.readerNames = []
+        self.atrs = {}
+        self.generations = {}
+        self.listeners = []
+        self.stopped = threading.Event()
+        self.thread = None
+        self.pcscMonitors = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def present(self, reader_name):
+        """Returns the ATR of the card in the reader, or None if there is none (no I/O)."""
+        with self.lock:
+            return self.atrs.get(reader_name)
+
+    def notify(self, event, reader_name, atr=None):
+        for listener in self.listeners:
+            listener(event, reader_name, atr)
+
+    def card_inserted(self, reader_name, atr):
+        with self.lock:
+            self.atrs[reader_name] = list(atr)
+        self.pool.notify_card_change()
+        self.notify('inserted', reader_name, list(atr))
+
+    def card_removed(self, reader_name):
+        with self.lock:
+            if self.atrs.pop(reader_name, None) is None:
+                return
+            self.generations.pop(reader_name, None)
+        # Drops the stale connection, which also lets the pool's listeners clear cached state
+        self.pool.invalidate(reader_name)
+        self.notify('removed', reader_name)
+
+    def readers_changed(self):
+        names = self.pool.refresh_readers()
+        with self.lock:
+            changed = names != self.readerNames
+            self.readerNames = names
+            gone = [name for name in self.atrs if name not in names]
+        for name in gone:
+            self.card_removed(name)
+        if changed:
+            self.notify('readers', None)
+        return names
+
+    def start(self):
+        self.pool.presence = self
+        if self.use_pcsc:
+            try:
+                self.start_pcsc()
+                return self
+            except ImportError:
+                self.use_pcsc = False
+        self.poll()  # Know the state of every reader before the first action
+        self.thread = threading.Thread(target=self.run_polling, name='card-monitor', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        for monitor, observer in self.pcscMonitors:
+            monitor.deleteObserver(observer)
+        self.pcscMonitors = []
+        if self.thread is not None:
+            self.thread.join()
+        if self.pool.presence is self:
+            self.pool.presence = None
+
+    def start_pcsc(self):
+        from smartcard.CardMonitoring import CardMonitor as PcscCardMonitor, CardObserver
+        from smartcard.ReaderMonitoring import ReaderMonitor, ReaderObserver
+        monitor = self
+
+        class CardEvents(CardObserver):
+            def update(self, observable, actions):
+                added, removed = actions
+                for card in removed:
+                    monitor.card_removed(str(card.reader))
+                for card in added:
+                    monitor.card_inserted(str(card.reader), card.atr)
+
+        class ReaderEvents(ReaderObserver):
+            def update(self, observable, actions):
+                monitor.readers_changed()
+
+        # Observers are told about the cards and readers already present when they register
+        for pcscMonitor, observer in ((ReaderMonitor(), ReaderEvents()), (PcscCardMonitor(), CardEvents())):
+            pcscMonitor.addObserver(observer)
+            self.pcscMonitors.append((pcscMonitor, observer))
+
+    def run_polling(self):
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception as e:
+                print(f'Card monitor: {str(e)}')
+
+    def poll(self):
+        for name in self.readers_changed():
+            try:
+                # The pool only reconnects when the ATR changed, so an unchanged card costs no APDU
+                connection = self.pool.get(name)
+            except Exception:
+                connection = None
+            if connection is None:
+                self.card_removed(name)
+                continue
+            generation = self.pool.card_generation(name)
+            with self.lock:
+                changed = self.generations.get(name) != generation
+                self.generations[name] = generation
+            if changed:
+                self.card_inserted(name, self.pool.current_atr(name) or [])
@@ -0,0 +1,203 @@
+import json
+import struct
+import zlib
+
+# Card payload layout (all integers big-endian):
+#   magic    2 bytes  b'SC'
+#   version  1 byte
+#   flags    1 byte   FLAG_COMPRESSED if the body is zlib-compressed,
+#                     FLAG_RAW if the body is opaque bytes rather than records
+#   length   4 bytes  length of the body as stored on the card
+#   crc32    4 bytes  CRC32 of the body as stored on the card
+#   body     records of field ID (1 byte), value length (LEB128 varint), UTF-8 value
+MAGIC = b'SC'
+VERSION = 1
+FLAG_COMPRESSED = 0x01
+FLAG_RAW = 0x02
+HEADER = struct.Struct('>2sBBII')
+HEADER_SIZE = HEADER.size
+
+# Fields of user_data.json get a one-byte ID instead of their key name.
+# List fields are stored as one record per item. IDs are part of the card
+# format: only ever append to this table.
+FIELD_IDS = {
+    'gender': 1,
+    'first_names': 2,
+    'last_names': 3,
+    'other_names': 4,
+    'email': 5,
+    'country': 6,
+    'country_phone': 7,
+    'timezone': 8,
+    'phone': 9,
+    'address_line_1': 10,
+    'address_line_2': 11,
+    'city': 12,
+    'state_province_territory': 13,
+    'postal_code': 14,
+    'username': 15,
+    'password': 16,
+    'passcode': 17,
+    'profile_video': 18,
+    'profile_picture': 19,
+    'fingerprint_images': 20,
+}
+LIST_FIELDS = {'fingerprint_images'}
+FIELD_NAMES = {fieldId: name for name, fieldId in FIELD_IDS.items()}
+
+# Any other key, or a value that is not a string, is stored as a compact JSON [key, value] pair
+GENERIC_FIELD_ID = 0
+
+
+class PayloadError(ValueError):
+    pass
+
+
+def encode_varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def decode_varint(buffer, position):
+    value = 0
+    shift = 0
+    while True:
+        if position >= len(buffer):
+            raise PayloadError('Truncated field length.')
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+def encode_record(fieldId, value):
+    return bytes([fieldId]) + encode_varint(len(value)) + value
+
+
+def encode_fields(data):
+    body = bytearray()
+    for key, value in data.items():
+        fieldId = FIELD_IDS.get(key)
+        # An empty list has no item records, so it goes into a generic record to survive the round trip
+        if key in LIST_FIELDS and isinstance(value, list) and value and all(isinstance(item, str) for item in value):
+            for item in value:
+                body += encode_record(fieldId, item.encode('utf-8'))
+        elif fieldId is not None and key not in LIST_FIELDS and isinstance(value, str):
+            body += encode_record(fieldId, value.encode('utf-8'))
+        else:
+            generic = json.dumps([key, value], separators=(',', ':'), ensure_ascii=False)
+            body += encode_record(GENERIC_FIELD_ID, generic.encode('utf-8'))
+    return bytes(body)
+
+
+def decode_fields(body):
+    data = {}
+    position = 0
+    while position < len(body):
+        fieldId = body[position]
+        length, position = decode_varint(body, position + 1)
+        if position + length > len(body):
+            raise PayloadError('Truncated field value.')
+        value = bytes(body[position:position + length]).decode('utf-8')
+        position += length
+        if fieldId == GENERIC_FIELD_ID:
+            key, value = json.loads(value)
+            data[key] = value
+        elif fieldId in FIELD_NAMES:
+            key = FIELD_NAMES[fieldId]
+            if key in LIST_FIELDS:
+                data.setdefault(key, []).append(value)
+            else:
+                data[key] = value
+        else:
+            raise PayloadError(f'Unknown field ID {fieldId}.')
+    return data
+
+
+def frame(body, flags=0):
+    """Prefixes body with the header carrying its length and CRC32."""
+    body = bytes(body)
+    return HEADER.pack(MAGIC, VERSION, flags, len(body), zlib.crc32(body)) + body
+
+
+def encode_payload(data, compress=False):
+    """Encodes a user_data dictionary into the compact card format.
+
+    With compress=True the body is deflated, unless that would make it larger.
+    """
+    body = encode_fields(data)
+    flags = 0
+    if compress:
+        compressed = zlib.compress(body, 9)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= FLAG_COMPRESSED
+    return frame(body, flags)
+
+
+def encode_raw(data):
+    """Frames arbitrary bytes (e.g. text typed in the basic view) so they can be CRC-verified."""
+    return frame(data, FLAG_RAW)
+
+
+def is_payload(raw):
+    """Tells a framed payload from other data, such as plain text that happens to start with "SC".
+
+    The header must be well formed and the body it announces present and matching its CRC.
+    """
+    try:
+        version, flags, length, crc = parse_header(raw)
+    except PayloadError:
+        return False
+    if version < 1 or flags & ~(FLAG_COMPRESSED | FLAG_RAW):
+        return False
+    body = bytes(raw[HEADER_SIZE:HEADER_SIZE + length])
+    return len(body) == length and zlib.crc32(body) == crc
+
+
+def parse_header(raw):
+    """Returns (version, flags, body length, crc32) from the first HEADER_SIZE bytes."""
+    if len(raw) < HEADER_SIZE:
+        raise PayloadError('Truncated payload header.')
+    magic, version, flags, length, crc = HEADER.unpack(bytes(raw[:HEADER_SIZE]))
+    if magic != MAGIC:
+        raise PayloadError('Not a card payload.')
+    if version > VERSION:
+        raise PayloadError(f'Unsupported payload version {version}.')
+    return version, flags, length, crc
+
+
+def unframe(raw):
+    """Checks the CRC and returns (flags, body) with the body already decompressed.
+
+    Trailing bytes (e.g. 0xFF padding) are ignored.
+    """
+    version, flags, length, crc = parse_header(raw)
+    body = bytes(raw[HEADER_SIZE:HEADER_SIZE + length])
+    if len(body) != length:
+        raise PayloadError('Truncated payload body.')
+    if zlib.crc32(body) != crc:
+        raise PayloadError('Payload CRC mismatch.')
+    if flags & FLAG_COMPRESSED:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error as e:
+            raise PayloadError(f'Corrupt compressed payload: {str(e)}')
+    return flags, body
+
+
+def decode_payload(raw):
+    """Decodes a user_data dictionary read from the card."""
+    flags, body = unframe(raw)
+    if flags & FLAG_RAW:
+        raise PayloadError('Payload holds raw bytes, not user data.')
+    return decode_fields(body)
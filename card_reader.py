@@ -1,34 +1,72 @@
 import sys
-from PyQt5.QtWidgets import QApplication, QWidget, QPushButton, QVBoxLayout, QTextEdit, QLineEdit, QLabel, QHBoxLayout, QComboBox, QStackedLayout
+from PyQt5.QtWidgets import QApplication, QWidget, QPushButton, QVBoxLayout, QTextEdit, QLineEdit, QLabel, QHBoxLayout, QComboBox, QStackedLayout, QCheckBox
 from PyQt5 import QtGui
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import QTimer, QObject, pyqtSignal
 from PyQt5 import QtCore
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QIntValidator
-from smartcard.System import readers
-from smartcard.util import toHexString, toBytes
+from smartcard.util import toBytes
 import smartcard
 import random
+import json
+from card_engine import CardEngine, CHIP_OPTIONS, MAX_ATMEL_WRITE_LENGTH, SLE5542_PROTECTED_BYTES, read_psc_from_file, write_psc_to_file
+from card_connection import ReaderConnectionPool
+from card_cache import CardImageCache
+from card_monitor import CardMonitor
+from card_jobs import CardJobQueue
+from card_simulator import install_from_environment
+from card_trace import trace_from_environment
+from card_payload import FLAG_RAW, decode_fields, encode_raw, is_payload, unframe
+
+class CardIOBridge(QObject):
+    """Carries progress and completion of card jobs, and card monitor events, to the GUI thread."""
+    progress = pyqtSignal(int, int, int)
+    finished = pyqtSignal(int, object)
+    cardEvent = pyqtSignal(str, object, object)
+
+    def reportProgress(self, job, done, total):
+        self.progress.emit(job.id, done, total)
+
 
 class SmartCardApp(QWidget):
     def __init__(self):
         super().__init__()
         self.memorySize = 256  # Default memory size for SLE5542
-        self.chipOptions = {
-            "AT24C01": (128, 8),
-            "AT24C02": (256, 8),
-            "AT24C04": (512, 16),
-            "AT24C08": (1024, 16),
-            "AT24C16": (2048, 16),
-            "AT24C32": (4096, 32),
-            "AT24C64": (8192, 32),
-            "AT24C128": (16384, 64),
-            "AT24C256": (32768, 64),
-            "AT24C512": (65536, 128),
-            "AT24C1024": (131072, 256),
-            "SLE5542": (256, 1)
-        }
+        self.chipOptions = CHIP_OPTIONS
+        self.engine = CardEngine()
+        self.connectionPool = ReaderConnectionPool()
+        # Pages already read or written are served from memory until the card leaves the reader
+        self.cardCache = CardImageCache()
+        self.engine.cache = self.cardCache
+        self.connectionPool.add_listener(self.cardCache.invalidate)
+        # Card reads and writes run on a dedicated thread so the window stays responsive
+        self.cardJobs = CardJobQueue()
+        self.cardJob = None
+        self.cardJobHandlers = {}
+        # Reader list changes that arrived during a job, applied once it finishes
+        self.readersChangedWhileBusy = False
+        # (write request, address) of a write that stopped part-way, so Write can pick up from there
+        self.pendingWrite = None
+        self.cardIO = CardIOBridge()
+        self.cardIO.progress.connect(self.onCardJobProgress)
+        self.cardIO.finished.connect(self.onCardJobFinished)
+        self.cardIO.cardEvent.connect(self.onCardEvent)
+        # Card insertion and removal are tracked in the background, so checking for a card costs no I/O
+        self.cardMonitor = CardMonitor(self.connectionPool)
+        self.cardMonitor.add_listener(self.cardIO.cardEvent.emit)
         self.initUI()
+        self.cardMonitor.start()
+
+    @property
+    def connection(self):
+        return self.engine.connection
+
+    @connection.setter
+    def connection(self, connection):
+        if connection is not self.engine.connection:
+            # Until the pool selects the card again there is no way to tell which card this is
+            self.engine.cache_key = None
+        self.engine.connection = connection
 
     def initUI(self):
         self.setGeometry(100, 100, 1000, 750)
@@ -109,6 +147,24 @@ class SmartCardApp(QWidget):
         self.basicWriteButton.clicked.connect(self.writeAsciiToCard)
         self.basicLayout.addWidget(self.basicWriteButton)
 
+        self.deltaWriteCheckBox = QCheckBox('Only write changed pages')
+        self.basicLayout.addWidget(self.deltaWriteCheckBox)
+
+        self.crcWriteCheckBox = QCheckBox('Write with CRC header and verify')
+        self.basicLayout.addWidget(self.crcWriteCheckBox)
+
+        self.cancelJobButton = QPushButton('Cancel')
+        self.cancelJobButton.clicked.connect(self.cancelCardJob)
+        self.cancelJobButton.setVisible(False)
+        self.basicLayout.addWidget(self.cancelJobButton)
+
+        self.progressLabel = QLabel('')
+        self.basicLayout.addWidget(self.progressLabel)
+
+        self.cardStatusLabel = QLabel('')
+        self.basicLayout.addWidget(self.cardStatusLabel)
+        self.updateCardStatus()
+
         # Text Areas for Writing and Reading
         self.basicTextInput = QTextEdit()
         self.basicTextInput.setPlaceholderText("Type here to write...")
@@ -140,25 +196,21 @@ class SmartCardApp(QWidget):
         self.readDataTextArea.clear()
         
     def makeNewReadConnection(self):
-        try:
-            selectedReaderName = self.readerComboBox.currentText()
-            # Find the reader object that matches the selected name
-            availableReaders = readers()
-            reader = next((r for r in availableReaders if str(r) == selectedReaderName), None)
-            if reader is None:
-                #print('No readers found. Plese check the connection and try again.')
-                return
-            
-            self.connection = reader.createConnection()
-            #print(self.connection)
-            self.connection.connect()
-            print(f'Connected to reader: {selectedReaderName}')
-        except Exception as e:
-            print(f'Error connecting to reader: {str(e)}')
+        if self.cardJob is not None:
+            return  # The running job keeps its connection and PSC session
+        selectedReaderName = self.readerComboBox.currentText()
+        result = self.connectionPool.connect(selectedReaderName)
+        if result.success:
+            self.connection = result.data
+            print(result.message)
+        elif selectedReaderName:
+            print(result.message)
+        self.engine.end_psc_session()
         try:
             if self.currentView == 'ADVANCED':
                 self.updateUIBasedOnChipType()
             elif self.currentView == 'BASIC':
+                self.updateCardStatus()
                 self.checkCardPresence()
         except:
             pass
@@ -170,24 +222,100 @@ class SmartCardApp(QWidget):
     def clearTemporaryMessage(self):
         self.successNotificationLabel.clear()
 
+    def startCardJob(self, operation, onFinished, *args, **kwargs):
+        """Runs a card operation on the I/O thread; onFinished(result) is called back on the GUI thread."""
+        if self.cardJob is not None:
+            self.showTemporaryMessage("Card is busy, please wait.")
+            return None
+        job = self.cardJobs.submit(operation, *args, progress=self.cardIO.reportProgress, **kwargs)
+        self.cardJob = job
+        self.cardJobHandlers[job.id] = onFinished
+        job.future.add_done_callback(lambda future, jobId=job.id: self.cardIO.finished.emit(jobId, future))
+        self.setCardBusy(True)
+        return job
+
+    def cancelCardJob(self):
+        if self.cardJob is not None:
+            self.cardJob.cancel()
+
+    def setCardBusy(self, busy):
+        # Everything that selects the card, swaps the connection or ends the PSC session
+        # would interleave its APDUs with the job's, so only Cancel stays available
+        for control in (self.readDataButton, self.basicWriteButton, self.readerComboBox, self.updateReadersButton,
+                        self.toggleViewButton, self.chipFamilyComboBox, self.advancedViewWidget):
+            control.setEnabled(not busy)
+        self.cancelJobButton.setVisible(busy)
+        if not busy:
+            self.progressLabel.clear()
+            self.updateCharacterCount()
+
+    def onCardJobProgress(self, jobId, done, total):
+        self.progressLabel.setText(f"{done}/{total} bytes")
+
+    def onCardJobFinished(self, jobId, future):
+        onFinished = self.cardJobHandlers.pop(jobId, None)
+        self.cardJob = None
+        self.setCardBusy(False)
+        if self.readersChangedWhileBusy:
+            self.readersChangedWhileBusy = False
+            self.updateAvailableReaders()
+        if future.cancelled():
+            self.showTemporaryMessage("Operation cancelled.")
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            self.uidTextEdit.append(f'Error during card operation: {str(e)}')
+            return
+        if onFinished is not None:
+            onFinished(result)
+
     def updateCharacterCount(self):
         memorySize = self.chipFamilyComboBox.currentData()  # Get the memory size for the selected chip
-        currentCharacters = len(self.basicTextInput.toPlainText())
+        # Non-ASCII characters take more than one byte on the card
+        currentCharacters = len(self.basicTextInput.toPlainText().encode('utf-8'))
         remainingCharacters = memorySize - currentCharacters  # Calculate the remaining characters
         self.charactersLeftLabel.setText(f"{currentCharacters}/{memorySize}")
         # Update the Write button enabled state based on the character count
-        self.basicWriteButton.setEnabled(currentCharacters <= memorySize)
+        self.basicWriteButton.setEnabled(currentCharacters <= memorySize and self.cardJob is None and self.cardPresent())
         self.dataLengthInput.setValidator(QIntValidator(1, memorySize))
-        self.checkCardPresence()
-        
+
+    def cardPresent(self):
+        return self.cardMonitor.present(self.readerComboBox.currentText()) is not None
+
+    def updateCardStatus(self):
+        atr = self.cardMonitor.present(self.readerComboBox.currentText())
+        if atr is None:
+            self.cardStatusLabel.setText('No card in reader.')
+        else:
+            self.cardStatusLabel.setText(f"Card present (ATR {bytes(atr).hex(' ').upper()}).")
+
+    def onCardEvent(self, event, readerName, atr):
+        if event == 'readers':
+            if self.cardJob is not None:
+                # Refilling the reader list would reconnect and re-select in the middle of the job
+                self.readersChangedWhileBusy = True
+            else:
+                self.updateAvailableReaders()
+            return
+        if readerName != self.readerComboBox.currentText():
+            return
+        # A new or removed card never keeps the old card's PSC verification
+        self.engine.end_psc_session()
+        self.updateCardStatus()
+        if event == 'inserted' and self.cardJob is None:
+            # Select the card as soon as it is inserted, so the next action can start right away
+            self.checkCardPresence()
+        self.updateCharacterCount()
+
     def checkCardPresence(self):
+        if not self.cardPresent():
+            return False
         chipType = self.chipFamilyComboBox.currentText()
         if chipType == 'SLE5542':
             status = self.select_card_type()
         elif chipType.startswith('AT24'):
             status = self.select_card_type_atmel()
-            if status:
-                self.select_page_size()    
         return status
     
     def writeAsciiToCard(self):
@@ -196,11 +324,11 @@ class SmartCardApp(QWidget):
             self.readDataTextArea.setText('Error: Card not found. Please check the connection and try again.')
             return
         text = self.basicTextInput.toPlainText()
-        asciiData = [ord(c) for c in text]  # Convert text to ASCII values
+        textData = text.encode('utf-8')
 
-        # Retrieve the chip type, memory size, and associated page size
+        # Retrieve the chip type and memory size
         chipType = self.chipFamilyComboBox.currentText()
-        memorySize, pageSize = self.chipOptions[chipType]
+        memorySize, _ = self.chipOptions[chipType]
 
         # Retrieve the byte offset from the input field
         byteOffsetText = self.byteOffsetInput.text()
@@ -227,40 +355,45 @@ class SmartCardApp(QWidget):
         if byteOffset + dataLength > memorySize or dataLength < 0:
             dataLength = memorySize - byteOffset  # Adjust dataLength to not exceed memorySize
 
-        # Write the ASCII data
-        totalWrittenBytes = 0
-        for i in range(0, len(asciiData), pageSize):
-            address = byteOffset + i
-            dataChunk = asciiData[i:i+pageSize]
-            
-            if chipType.startswith('AT24'):
-                writeStatus, message = self.writeCardDataAtmel(address, dataChunk)
-            elif chipType == 'SLE5542':
-                (addr, length_written, message), writeStatus = self.write_memory(address, dataChunk)
-            
-            if not writeStatus:
-                self.uidTextEdit.append(f'Failed to write data chunk: {message}')
-                return
-            totalWrittenBytes += len(dataChunk)
-
-        # Fill the rest of the specified length with FF, if applicable
-        remainingBytes = dataLength - totalWrittenBytes
-        if remainingBytes > 0:
-            fillData = [0xFF] * remainingBytes
-            for i in range(0, remainingBytes, pageSize):
-                address = byteOffset + totalWrittenBytes + i
-                dataChunk = fillData[i:i+pageSize]
-
-                if chipType.startswith('AT24'):
-                    writeStatus, message = self.writeCardDataAtmel(address, dataChunk)
-                elif chipType == 'SLE5542':
-                    writeStatus, message = self.write_memory(address, dataChunk)
+        if self.crcWriteCheckBox.isChecked():
+            textData = encode_raw(textData)
+        delta = self.deltaWriteCheckBox.isChecked()
+        verifyCrc = self.crcWriteCheckBox.isChecked()
+
+        # Only the same data going to the same card can continue where an earlier write stopped
+        request = (self.engine.cache_key, chipType, byteOffset, dataLength, bytes(textData))
+        resumeOffset = None
+        if self.pendingWrite is not None and self.pendingWrite[0] == request:
+            resumeOffset = self.pendingWrite[1]
+            self.uidTextEdit.append(f'Resuming the previous write at address {resumeOffset:X}.')
+        self.pendingWrite = None
+
+        def writeAndVerify(progress, cancel):
+            result = self.engine.write(chipType, byteOffset, textData, dataLength, delta=delta,
+                                       progress=progress, cancel=cancel, resume_offset=resumeOffset)
+            if not result.success or not verifyCrc:
+                return result, None, request
+            return result, self.engine.verify_crc(chipType, byteOffset, textData, cancel=cancel), request
+
+        self.startCardJob(writeAndVerify, self.onWriteFinished)
+
+    def onWriteFinished(self, results):
+        result, verify, request = results
+        if not result.success:
+            self.uidTextEdit.append(result.message)
+            if result.data and 'resume_offset' in result.data:
+                self.pendingWrite = (request, result.data['resume_offset'])
+                self.uidTextEdit.append(f"Write stopped at address {result.data['resume_offset']:X}. "
+                                        f"Press Write again to resume from there.")
+            return
 
-                if not writeStatus:
-                    self.uidTextEdit.append(f'Failed to fill remaining memory: {message}')
-                    return
+        if verify is not None:
+            self.uidTextEdit.append(verify.message)
+            if not verify.success:
+                self.readDataTextArea.setText(verify.message)
+                return
 
-        self.showTemporaryMessage("Data written successfully.")
+        self.showTemporaryMessage(f"Data written successfully. {result.data['blank_pages_skipped']} blank pages skipped.")
 
     def readAsciiFromCard(self):
         status = self.checkCardPresence()
@@ -279,7 +412,7 @@ class SmartCardApp(QWidget):
                 return
 
         chipType = self.chipFamilyComboBox.currentText()
-        memorySize, pageSize = self.chipOptions[chipType]
+        memorySize, _ = self.chipOptions[chipType]
 
         try:
             dataLength = int(self.dataLengthInput.text()) if self.dataLengthInput.text() else memorySize - byteOffset
@@ -290,35 +423,37 @@ class SmartCardApp(QWidget):
             dataLength = memorySize - byteOffset
             self.uidTextEdit.append(f'Note: Adjusting read length to stay within memory bounds. Reading {dataLength} bytes.')
 
-        readData = []
-        totalReadBytes = 0
-
-        if chipType == 'SLE5542':
-            dataLength = dataLength - 1
-
-        while totalReadBytes < dataLength:
-            currentLength = min(pageSize, dataLength - totalReadBytes)
-            if chipType.startswith('AT24'):
-                success, chunk = self.readCardDataAtmel(byteOffset + totalReadBytes, currentLength)
-            elif chipType == 'SLE5542':
-                (addr, length_read, chunk), success = self.read_memory(byteOffset + totalReadBytes, currentLength)
-            else:
-                self.uidTextEdit.append(f'Error: Unsupported chip type {chipType}.')
-                return
+        self.startCardJob(self.engine.read, self.onReadFinished, chipType, byteOffset, dataLength)
 
-            if success and chunk is not None:
-                readData.extend(chunk)
-                totalReadBytes += len(chunk)
-            else:
-                self.uidTextEdit.append('Failed to read data.')
-                return
+    def onReadFinished(self, result):
+        if not result.success:
+            self.uidTextEdit.append(result.message)
+            return
+        readData = result.data
 
-        readDataStr = ''.join([' ' if byte == 0xFF else chr(byte) for byte in readData])
+        readDataStr = None
+        if is_payload(readData):
+            # Cards encoded by card_save.py or written with a CRC header hold a framed payload
+            try:
+                flags, body = unframe(readData)
+                if flags & FLAG_RAW:
+                    readDataStr = body.decode('utf-8', errors='replace')
+                else:
+                    readDataStr = json.dumps(decode_fields(body), indent=4)
+            except ValueError as e:
+                # Show the bytes as text rather than nothing
+                self.uidTextEdit.append(f'Failed to decode card payload, showing it as text: {str(e)}')
+        if readDataStr is None:
+            # 0xFF never occurs in UTF-8, so it can only be erased memory
+            readDataStr = readData.replace(b'\xff', b' ').decode('utf-8', errors='replace')
         self.readDataTextArea.setText(readDataStr)
         self.showTemporaryMessage("Data read successfully.")
 
 
     def toggleView(self):
+        if self.cardJob is not None:
+            self.showTemporaryMessage("Card is busy, please wait.")
+            return
         if self.currentView == 'ADVANCED':
             self.stackedLayout.setCurrentIndex(1)  # Switch to Basic View
             self.toggleViewButton.setText('Switch to ADVANCED View')
@@ -373,11 +508,12 @@ class SmartCardApp(QWidget):
 
         if chipType == "SLE5542":
             self.setupUIForSLE5542()
-            self.select_card_type()
+            if self.cardJob is None:
+                self.select_card_type()
         elif chipType == "AT24CXX":
             self.setupUIForAT24CXX()
-            self.select_card_type_atmel()
-            self.select_page_size()
+            if self.cardJob is None:
+                self.select_card_type_atmel()
 
     def setupUIForSLE5542(self):
         # Create a layout for read operations
@@ -522,153 +658,62 @@ class SmartCardApp(QWidget):
             self.uidTextEdit.append('Failed to write data.')
 
     def readCardDataAtmel(self, address, length):
-        try:
-            # Make sure address and length are within valid range
-            if address < 0 or length <= 0:
-                self.uidTextEdit.append('Error: Address and length must be positive numbers.')
-                return None
-            
-            # Construct the command for reading data
-            command = [0xFF, 0xB0, address >> 8, address & 0xFF, length]
-            data, sw1, sw2 = self.connection.transmit(command)
-            
-            if (sw1, sw2) == (0x90, 0x00):
-                # Successfully read the data
-                length = length + 1
-                self.uidTextEdit.append(f'Read Successful: Addr: {address:X}, Length: {length}')
-                self.uidTextEdit.append(toHexString(data))
-                return (True, data)
-            else:
-                # Error in reading the data
-                self.uidTextEdit.append(f"Error reading memory with SW1 SW2 = {sw1:02X} {sw2:02X}")
-                return (False, None)
-        except Exception as e:
-            self.uidTextEdit.append(f'Exception during read: {str(e)}')
+        result = self.engine.read_atmel(address, length)
+        self.uidTextEdit.append(result.message)
+        if not result.success:
             return (False, None)
+        self.uidTextEdit.append(result.data.hex(' ').upper())
+        return (True, result.data)
 
     def writeCardDataAtmel(self, address, dataToWrite):
-        try:
-            # Check if dataToWrite is valid
-            if not dataToWrite:
-                self.uidTextEdit.append('Error: Data to write is null.')
-                return False
-            if len(dataToWrite) > 32:
-                self.uidTextEdit.append('Error: Data length exceeds page size.')
-                return False
-            
-            # Convert the data to be written into a list of bytes if necessary
-            if isinstance(dataToWrite, str):
-                dataToWrite = toBytes(dataToWrite)
-            
-            # Construct the command for writing data
-            command = [0xFF, 0xD0, address >> 8, address & 0xFF, len(dataToWrite)] + dataToWrite
-            _, sw1, sw2 = self.connection.transmit(command)
-            
-            if (sw1, sw2) == (0x90, 0x00):
-                return (True, 'Data written successfully')
-            else:
-                return (False, f'Failed to write data with SW1 SW2 = {sw1:02X} {sw2:02X}')
-        except Exception as e:
-            return (False, f'Error writing data: {str(e)}')
+        # Convert the data to be written into a list of bytes if necessary
+        if isinstance(dataToWrite, str):
+            dataToWrite = toBytes(dataToWrite)
+        _, pageSize = self.chipOptions[self.chipFamilyComboBox.currentText()]
+        result = self.engine.write_atmel(address, dataToWrite, min(pageSize, MAX_ATMEL_WRITE_LENGTH))
+        return (result.success, result.message)
 
     def select_page_size(self):
-        command = [0xFF, 0x01, 0x00, 0x00, 0x01, 0x05]  # Command to select 32-byte page size
-        data, sw1, sw2 = self.connection.transmit(command)
-        if (sw1, sw2) == (0x90, 0x00):
-            self.uidTextEdit.append('Page size selected successfully.')
-        else:
-            self.uidTextEdit.append(f"Error selecting page size with SW1 SW2 = {sw1:02X} {sw2:02X}")
+        result = self.engine.select_page_size()
+        self.uidTextEdit.append(result.message)
 
     def updateAvailableReaders(self):
+        readerNames = self.connectionPool.refresh_readers()
+        if readerNames == [self.readerComboBox.itemText(i) for i in range(self.readerComboBox.count())]:
+            return
+        selectedReaderName = self.readerComboBox.currentText()
         self.readerComboBox.clear()
-        for reader in readers():
+        for reader in readerNames:
             print(reader)
-            self.readerComboBox.addItem(str(reader))
+            self.readerComboBox.addItem(reader)
+        if selectedReaderName in readerNames:
+            self.readerComboBox.setCurrentText(selectedReaderName)
+
+    def selectCardOnReader(self, chipType):
+        # The pool only reconnects and re-sends the select APDU after a card swap
+        selectedReaderName = self.readerComboBox.currentText()
+        result = self.connectionPool.ensure_selected(selectedReaderName, chipType, self.engine)
+        self.uidTextEdit.append(result.message)
+        if result.success:
+            self.connection = result.data
+        return result.success
 
     def select_card_type_atmel(self):
-        try:
-            selectedReaderName = self.readerComboBox.currentText()
-            # Find the reader object that matches the selected name
-            availableReaders = readers()
-            reader = next((r for r in availableReaders if str(r) == selectedReaderName), None)
-            if reader is None:
-                self.uidTextEdit.append('Selected reader not found')
-                return
-            
-            self.connection = reader.createConnection()
-            self.connection.connect()
-            self.uidTextEdit.append(f'Connected to reader: {selectedReaderName}')
-            
-            command = [0xFF, 0xA4, 0x00, 0x00, 0x01, 0x02]  # Command to select the AT24CXX card
-            data, sw1, sw2 = self.connection.transmit(command)
-            if (sw1, sw2) == (0x90, 0x00):
-                self.uidTextEdit.append('Card type selected successfully.')
-                return True
-            else:
-                self.uidTextEdit.append(f"Error selecting card type with SW1 SW2 = {sw1:02X} {sw2:02X}")
-                return False
-        except Exception as e:
-            print(f"Error selecting card type: {str(e)}")
-            self.uidTextEdit.append(f"Error selecting card type: {str(e)}")
-            return False    
+        return self.selectCardOnReader('AT24CXX')
 
     def clearText(self):
         self.uidTextEdit.clear()
 
     def select_card_type(self):
-        try:
-            selectedReaderName = self.readerComboBox.currentText()
-            # Find the reader object that matches the selected name
-            availableReaders = readers()
-            reader = next((r for r in availableReaders if str(r) == selectedReaderName), None)
-            if reader is None:
-                self.uidTextEdit.append('Selected reader not found')
-                return
-            
-            self.connection = reader.createConnection()
-            self.connection.connect()
-            self.uidTextEdit.append(f'Connected to reader: {selectedReaderName}')
-            
-            command = [0xFF, 0xA4, 0x00, 0x00, 0x01, 0x06]  # Command for selecting card type
-            data, sw1, sw2 = self.connection.transmit(command)
-            
-            if (sw1, sw2) == (0x90, 0x00):
-                self.uidTextEdit.append('Card type selected successfully.')
-                return True
-            else:
-                self.uidTextEdit.append(f'Select card type failed with SW1 SW2 = {sw1:02X} {sw2:02X}')
-                return False
-        except Exception as e:
-            self.uidTextEdit.append(f'Error selecting card type: {str(e)}')
-            return False
+        return self.selectCardOnReader('SLE5542')
 
-    def read_memory(self, address, length):
-        if address + length > self.memorySize - 1 or address < 0 or length <= 0:
-            return (address, length, 'Address or length out of bounds'), False
-        try:
-            command = [0xFF, 0xB0, 0x00, address, length]
-            data, sw1, sw2 = self.connection.transmit(command)
-            if (sw1, sw2) == (0x90, 0x00):
-                return (address, length, data), True
-            else:
-                return (address, length, f'Failed to read data with SW1 SW2 = {sw1:02X} {sw2:02X}'), False
-        except Exception as e:
-            return (address, length, f'Error reading data: {str(e)}'), False
+    def read_memory(self, address, length, cached=True):
+        result = self.engine.read_memory(address, length, cached)
+        return (address, length, result.data if result.success else result.message), result.success
 
     def write_memory(self, address, dataToWrite):
-        if address + len(dataToWrite) > self.memorySize - 1 or address < 0:
-            return (address, len(dataToWrite), 'Address or data length out of bounds'), False
-        if not self.verify_psc():
-            return (address, len(dataToWrite), 'PSC verification failed. Cannot perform write operation.'), False
-        try:
-            command = [0xFF, 0xD0, 0x00, address, len(dataToWrite)] + list(dataToWrite)
-            _, sw1, sw2 = self.connection.transmit(command)
-            if (sw1, sw2) == (0x90, 0x00):
-                return (address, len(dataToWrite), 'Data written successfully'), True
-            else:
-                return (address, len(dataToWrite), f'Failed to write data with SW1 SW2 = {sw1:02X} {sw2:02X}'), False
-        except Exception as e:
-            return (address, len(dataToWrite), f'Error writing data: {str(e)}'), False
+        result = self.engine.write_memory(address, dataToWrite)
+        return (address, len(dataToWrite), result.message), result.success
 
     def readCardData(self):
         try:
@@ -685,24 +730,19 @@ class SmartCardApp(QWidget):
                 return
 
             (addr, length_read, readData), success = self.read_memory(address, length-1)
-            readData = toHexString(readData)
-            hexValues = readData.split()
             if success:
-                protectable_memory = []
-                data_memory = []
-                for i in range(len(hexValues)):
-                    if i < 33:
-                        protectable_memory.append(hexValues[i])
-                    else:
-                        data_memory.append(hexValues[i])
-                
+                # Only the first 32 bytes of the card can be write-protected
+                split = max(0, min(len(readData), SLE5542_PROTECTED_BYTES - addr))
+                protectable_memory = readData[:split]
+                data_memory = readData[split:]
+
                 self.uidTextEdit.append(f'Addr: {addr:X}, Length: {length_read+1}')
                 if protectable_memory:
                     self.uidTextEdit.append('Protectable Memory:')
-                    self.uidTextEdit.append(' '.join(protectable_memory))
+                    self.uidTextEdit.append(protectable_memory.hex(' ').upper())
                 if data_memory:
                     self.uidTextEdit.append('Data Memory:')
-                    self.uidTextEdit.append(' '.join(data_memory))
+                    self.uidTextEdit.append(data_memory.hex(' ').upper())
             else:
                 self.uidTextEdit.append(f'Failed to read data: {readData}')
         except Exception as e:
@@ -739,79 +779,43 @@ class SmartCardApp(QWidget):
             self.uidTextEdit.append(f'Error writing data: {str(e)}')
 
     def verify_psc(self):
-        psc = self.read_psc_from_file()  # Reads the PSC from the file
-        if not psc:
-            self.uidTextEdit.append('Failed to retrieve PSC for verification.')
-            return False
-        
-        try:
-            # Construct the command to submit the PSC
-            command = [0xFF, 0x20, 0x00, 0x00, 0x03] + psc
-            data, sw1, sw2 = self.connection.transmit(command)
-            
-            # Interpret the response based on SW2
-            if sw1 == 0x90:  # Check if SW1 indicates success
-                if sw2 == 0x07:  # Verification is correct
-                    # Move cursor to the end of the text
-                    self.uidTextEdit.moveCursor(QtGui.QTextCursor.End)
-                    # Insert text at the current cursor position, which is now at the end
-                    self.uidTextEdit.insertPlainText('/PSC ✔')
-                    return True
-                elif sw2 == 0x00:  # Password is locked
-                    self.uidTextEdit.append('PSC verification failed: password is locked.')
-                else:  # Other values indicate failed verification attempts
-                    self.uidTextEdit.append(f'PSC verification failed: current error count is {sw2}. ✖')
-            else:
-                self.uidTextEdit.append(f'Failed to verify PSC with SW1 SW2 = {sw1:02X} {sw2:02X} ✖')
-            return False
-        except Exception as e:
-            self.uidTextEdit.append(f'Error during PSC verification: {str(e)} ✖')
-            return False
+        # An explicit verify picks up edits to the PSC file
+        self.engine.psc = None
+        result = self.engine.verify_psc()
+        if result.success:
+            # Move cursor to the end of the text
+            self.uidTextEdit.moveCursor(QtGui.QTextCursor.End)
+            # Insert text at the current cursor position, which is now at the end
+            self.uidTextEdit.insertPlainText('/PSC ✔')
+        else:
+            self.uidTextEdit.append(f'{result.message} ✖')
+        return result.success
 
     def change_secret_code(self, new_psc):
-        if self.verify_psc():
-            command = [0xFF, 0xD2, 0x00, 0x01, 0x03] + new_psc
-            data, sw1, sw2 = self.connection.transmit(command)
-            
-            if (sw1, sw2) == (0x90, 0x00):
-                self.write_psc_to_file(new_psc)
-                self.uidTextEdit.append('Secret code changed successfully.')
-            else:
-                self.uidTextEdit.append('Failed to change secret code.')
-        else:
-            self.uidTextEdit.append('Current PSC verification required before changing the code.')
+        result = self.engine.change_secret_code(new_psc)
+        self.uidTextEdit.append(result.message)
+        if result.success:
+            self.uidTextEdit.append('PSC updated in file.')
 
     def read_protection_bits(self):
         self.uidTextEdit.append(' ')
-        if not hasattr(self, 'connection'):
+        if self.connection is None:
             self.uidTextEdit.append('No connection to card. Please establish connection first.')
             return
-        
-        try:
-            command = [0xFF, 0xB2, 0x00, 0x00, 0x04]  # Command to read protection bits
-            data, sw1, sw2 = self.connection.transmit(command)
-            
-            if (sw1, sw2) == (0x90, 0x00):
-                # Assuming data contains PROT 1 to PROT 4 as the first 4 bytes
-                protection_bits_hex = ' '.join([f'{byte:02X}' for byte in data[:4]])
-                protection_bits_binary = ' '.join([f'{byte:08b}' for byte in data[:4]])
-                
-                self.uidTextEdit.append(f'Protection bits (Hex): {protection_bits_hex}')
-                self.uidTextEdit.append(f'Protection bits (Binary): {protection_bits_binary}')
-            else:
-                self.uidTextEdit.append(f'Failed to read protection bits with SW1 SW2 = {sw1:02X} {sw2:02X}')
-        except Exception as e:
-            self.uidTextEdit.append(f'Error reading protection bits: {str(e)}')
 
-    def read_presentation_error_counter(self):
-        command = [0xFF, 0xB1, 0x00, 0x00, 0x04]
-        data, sw1, sw2 = self.connection.transmit(command)
-        
-        if (sw1, sw2) == (0x90, 0x00) and len(data) > 0:
-            error_counter = data[0]
-            self.uidTextEdit.append(f'Presentation error counter: {error_counter}')
+        result = self.engine.read_protection_bits()
+        if result.success:
+            protection_bits_hex = ' '.join([f'{byte:02X}' for byte in result.data])
+            protection_bits_binary = ' '.join([f'{byte:08b}' for byte in result.data])
+
+            self.uidTextEdit.append(f'Protection bits (Hex): {protection_bits_hex}')
+            self.uidTextEdit.append(f'Protection bits (Binary): {protection_bits_binary}')
         else:
-            self.uidTextEdit.append('Failed to read presentation error counter.')
+            self.uidTextEdit.append(result.message)
+
+    def read_presentation_error_counter(self):
+        result = self.engine.read_presentation_error_counter()
+        self.uidTextEdit.append(result.message)
 
     def read_psc_display(self):
         self.uidTextEdit.append(' ')
@@ -824,27 +828,19 @@ class SmartCardApp(QWidget):
             self.uidTextEdit.append('Failed to read PSC from file.')
 
     def read_psc_from_file(self, filename="psc.txt"):
-        try:
-            with open(filename, "r") as file:
-                # Read the PSC, strip whitespace and spaces, then parse
-                psc_hex = file.readline().strip().replace(" ", "")
-                return [int(psc_hex[i:i+2], 16) for i in range(0, len(psc_hex), 2)]
-        except FileNotFoundError:
-            self.uidTextEdit.append('PSC file not found, using default PSC.')
-            return [0xFF, 0xFF, 0xFF]
-        except ValueError as e:
-            self.uidTextEdit.append(f'Error parsing PSC: {str(e)}')
-            return [0xFF, 0xFF, 0xFF]
+        psc, message = read_psc_from_file(filename)
+        if message:
+            self.uidTextEdit.append(message)
+        return psc
 
     def write_psc_to_file(self, psc, filename="psc.txt"):
-        psc_hex = ''.join([f"{byte:02X}" for byte in psc])
-        with open(filename, "w") as file:
-            file.write(psc_hex)
-            self.uidTextEdit.append('PSC updated in file.')
+        write_psc_to_file(psc, filename)
+        self.engine.psc = None
+        self.uidTextEdit.append('PSC updated in file.')
 
     def run_automated_test(self):
         self.uidTextEdit.append(' ')
-        if not hasattr(self, 'connection'):
+        if self.connection is None:
             self.uidTextEdit.append('No connection to card. Please establish connection first.')
             return
 
@@ -854,13 +850,12 @@ class SmartCardApp(QWidget):
         self.uidTextEdit.append(f'Testing address: h\'{address:X}\', writing value: h\'{test_value[0]:02X}\'')
 
         # Step 1: Read the original value
-        (addr, length, original_value), success = self.read_memory(address, 1)
-        original_value = toHexString(original_value)
+        (addr, length, original_value_bytes), success = self.read_memory(address, 1)
         if not success:
-            self.uidTextEdit.append(f'Failed to read from address h\'{addr:X}\': {original_value}')
+            self.uidTextEdit.append(f'Failed to read from address h\'{addr:X}\': {original_value_bytes}')
             return
 
-        original_value_bytes = [int(original_value[i:i+2], 16) for i in range(0, len(original_value), 2)]
+        original_value = original_value_bytes.hex(' ').upper()
         self.uidTextEdit.append(f'Original value at address h\'{addr:X}\': {original_value}')
 
         # Step 2: Write the test value
@@ -871,17 +866,17 @@ class SmartCardApp(QWidget):
 
         self.uidTextEdit.append(f'Wrote test value h\'{test_value[0]:02X}\' at address h\'{addr:X}\'')
 
-        # Step 3: Read back the value
-        (addr, length, read_back_value), success = self.read_memory(address, 1)
-        read_back_value = toHexString(read_back_value)  
+        # Step 3: Read back the value from the card itself, not the cache
+        (addr, length, read_back_bytes), success = self.read_memory(address, 1, cached=False)
         if not success:
-            self.uidTextEdit.append(f'Failed to read back from address h\'{addr:X}\': {read_back_value}')
+            self.uidTextEdit.append(f'Failed to read back from address h\'{addr:X}\': {read_back_bytes}')
             return
+        read_back_value = read_back_bytes.hex(' ').upper()
 
         self.uidTextEdit.append(f'Read back value at address h\'{addr:X}\': {read_back_value}')
 
         # Step 4: Verify the write operation
-        if read_back_value == toHexString(test_value):
+        if read_back_bytes == bytes(test_value):
             self.uidTextEdit.append(f'Successfully verified write at address h\'{addr:X}\'. Value: h\'{read_back_value}\'')
         else:
             self.uidTextEdit.append(f'Verification failed at address h\'{addr:X}\'. Expected h\'{test_value[0]:02X}\', got h\'{read_back_value}\'')
@@ -894,6 +889,8 @@ class SmartCardApp(QWidget):
             self.uidTextEdit.append(f'Failed to restore original value at address h\'{addr:X}\': {message}')
 
 def main():
+    install_from_environment()
+    trace_from_environment()
     app = QApplication(sys.argv)
     ex = SmartCardApp()
     ex.show()
@@ -1,8 +1,9 @@
 import json
-import sys
-from card_reader import SmartCardApp  # Import your main class or functions from card_reader.py
-from PyQt5.QtWidgets import QApplication  
-from PyQt5.QtWidgets import QTextEdit  
+from card_engine import CardEngine, CardResult, CHIP_OPTIONS
+from card_jobs import CardJobQueue
+from card_payload import encode_payload
+from card_simulator import install_from_environment
+from card_trace import trace_from_environment
 
 
 def read_json_data(file_path):
@@ -11,54 +12,69 @@ def read_json_data(file_path):
         data = json.load(file)
     return data
 
-def write_and_verify_data_on_card(app, data):
-    """Writes data to the AT24C64 chip, updates the GUI, and verifies the write operation."""
-    # Convert the entire data dictionary to a formatted string for display and writing
-    text_data = json.dumps(data, indent=4)
-    
-    print("Updating the GUI with data...")
-    if hasattr(app, 'basicTextInput') and isinstance(app.basicTextInput, QTextEdit):
-        app.basicTextInput.setText(text_data)  # Update the widget's text
-        print(text_data)
-    else:
-        print("The basicTextInput field is not accessible.")
-    
-    # Write data to card
-    app.writeAsciiToCard()  
+def write_and_verify_data_on_card(engine, data, chip_type="AT24C64", compress=True, verify_pages=False):
+    """Writes data to the AT24C64 chip in the compact card format and verifies it by CRC.
+
+    With verify_pages=True each page is also read back as soon as it is written.
+    """
+    # Select the card and read its current image on the I/O thread while the payload is encoded
+    jobs = CardJobQueue()
+    prepared = jobs.submit(lambda progress, cancel: engine.prepare(chip_type))
+    current = jobs.submit(engine.read_range, chip_type, 0, CHIP_OPTIONS[chip_type][0])
 
-    # Read back data from card for verification
-    app.readAsciiFromCard()  
-    read_back_data = app.readDataTextArea.toPlainText()
+    payload = encode_payload(data, compress=compress)
+    print(f"Encoded {len(json.dumps(data, indent=4))} bytes of JSON as a {len(payload)} byte card payload.")
 
-    #print("Data read back from the card:", read_back_data)
+    result = prepared.result()
+    if not result.success:
+        current.cancel()
+        jobs.shutdown()
+        print(f"Error: Card not found. {result.message}")
+        return False
+    current = current.result().data
+    jobs.shutdown()
 
-    # Verify if the written data matches the read back data
-    if read_back_data.strip() == text_data.strip():
-        print("Data verification successful: Data written matches data read back.")
+    result = encode_card(engine, payload, chip_type, verify_pages, current)
+    if result.data:
+        print(f"Pages written: {result.data['pages_written']}, unchanged pages skipped: {result.data['pages_skipped']} "
+              f"({result.data['blank_pages_skipped']} of them already blank padding)")
+    if result.success:
+        print(f"Data verification successful: {result.message}")
+        return True
     else:
-        print("Data verification failed: Written data does not match read back data.")
+        print(f"Data verification failed: {result.message}")
+        return False
+
+def encode_card(engine, payload, chip_type="AT24C64", verify_pages=False, current=None):
+    """Delta-writes an encoded payload to a selected card and verifies it by CRC."""
+    # Write data to card, skipping pages that already hold the right bytes
+    written = engine.write(chip_type, 0, payload, delta=True, verify_pages=verify_pages, current=current)
+    if not written.success:
+        return CardResult(False, written.data, f"Failed to write data: {written.message}")
+
+    # Read back only the header and payload and check them against the CRC
+    verified = engine.verify_crc(chip_type, 0, payload)
+    return CardResult(verified.success, written.data, verified.message)
 
 def main(file_path):
-    applic = QApplication(sys.argv)
-    app = SmartCardApp()
-    #app.show()
-    
+    engine = CardEngine()
+    result = engine.connect()
+    if not result.success:
+        print(result.message)
+        return
+
     data = read_json_data(file_path)
     print(type(data))
-    
+
     try:
         print("Writing data to the card...")
-
-        app.set_chip_family("AT24C64")
-        
-        write_and_verify_data_on_card(app, data)
+        write_and_verify_data_on_card(engine, data)
 
     except Exception as e:
         print(f"An error occurred: {e}")
 
-    #sys.exit(applic.exec_())
-
 if __name__ == '__main__':
-    
+    install_from_environment()
+    trace_from_environment()
     json_file_path = "user_data.json"
     main(json_file_path)
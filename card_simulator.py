@@ -0,0 +1,306 @@
+import os
+import time
+from card_engine import CHIP_OPTIONS, is_atmel, set_readers_backend
+
+SW_OK = (0x90, 0x00)
+SW_WRONG_LENGTH = (0x67, 0x00)
+SW_SECURITY_NOT_SATISFIED = (0x69, 0x82)
+SW_CONDITIONS_NOT_SATISFIED = (0x69, 0x85)
+SW_WRONG_PARAMETERS = (0x6B, 0x00)
+SW_INS_NOT_SUPPORTED = (0x6D, 0x00)
+
+# Page size codes accepted by the reader's 0x01 select-page-size APDU
+PAGE_SIZE_CODES = {0x03: 8, 0x04: 16, 0x05: 32, 0x06: 64, 0x07: 128}
+
+# Memory cards carry no serial number: every card of a family answers with the same ATR
+AT24_ATR = [0x3B, 0x04, 0x49, 0x32, 0x43, 0x2E]
+SLE5542_ATR = [0x3B, 0x04, 0xA2, 0x13, 0x10, 0x91]
+
+
+class SimulatedCardError(Exception):
+    pass
+
+
+class SimulatedAT24Card:
+    """AT24Cxx serial EEPROM: sequential reads roll over the whole array, writes wrap inside one page."""
+
+    card_types = (0x01, 0x02)
+
+    def __init__(self, chip_type="AT24C64", write_latency=0.0):
+        self.chip_type = chip_type
+        self.memorySize, self.pageSize = CHIP_OPTIONS[chip_type]
+        self.memory = bytearray([0xFF] * self.memorySize)
+        self.write_latency = write_latency
+        self.page_writes = 0
+
+    def atr(self):
+        return list(AT24_ATR)
+
+    def reset(self):
+        pass
+
+    def read(self, address, length):
+        address %= self.memorySize
+        data = self.memory[address:address + length]
+        while len(data) < length:
+            data += self.memory[:length - len(data)]
+        return SW_OK, list(data)
+
+    def write(self, address, data):
+        # Bytes past the end of the page wrap around to the start of the same page
+        pageStart = address - address % self.pageSize
+        for i, byte in enumerate(data):
+            self.memory[pageStart + (address + i - pageStart) % self.pageSize] = byte
+        self.page_writes += 1
+        if self.write_latency:
+            time.sleep(self.write_latency)
+        return SW_OK
+
+
+class SimulatedSLE5542Card:
+    """SLE5542 memory card with PSC verification, error counter and write-protected first 32 bytes."""
+
+    card_types = (0x05, 0x06)
+    memorySize = 256
+    protectedBytes = 32
+
+    def __init__(self, psc=(0xFF, 0xFF, 0xFF), protection_bits=(0xFF, 0xFF, 0xFF, 0xFF), write_latency=0.0):
+        self.chip_type = "SLE5542"
+        self.memory = bytearray([0xFF] * self.memorySize)
+        self.psc = list(psc)
+        self.error_counter = 0x07
+        self.protection = bytearray(protection_bits)
+        self.write_latency = write_latency
+        self.verified = False
+        self.page_writes = 0
+        self.blocked_writes = 0
+
+    def atr(self):
+        return list(SLE5542_ATR)
+
+    def reset(self):
+        # PSC verification only lasts until the card is powered down
+        self.verified = False
+
+    def is_protected(self, address):
+        if address >= self.protectedBytes:
+            return False
+        # A cleared protection bit means the byte can no longer be changed
+        return not self.protection[address // 8] & (1 << (address % 8))
+
+    def read(self, address, length):
+        if address + length > self.memorySize:
+            return SW_WRONG_PARAMETERS, []
+        return SW_OK, list(self.memory[address:address + length])
+
+    def write(self, address, data):
+        if address + len(data) > self.memorySize:
+            return SW_WRONG_PARAMETERS
+        if not self.verified:
+            return SW_SECURITY_NOT_SATISFIED
+        for i, byte in enumerate(data):
+            if self.is_protected(address + i):
+                self.blocked_writes += 1
+                continue
+            self.memory[address + i] = byte
+        self.page_writes += 1
+        if self.write_latency:
+            time.sleep(self.write_latency)
+        return SW_OK
+
+    def verify(self, psc):
+        if self.error_counter == 0:
+            return (0x90, 0x00)  # Card is locked
+        if list(psc) == self.psc:
+            self.error_counter = 0x07
+            self.verified = True
+        else:
+            # Each failed presentation clears one bit of the error counter
+            self.error_counter = (self.error_counter << 1) & 0x07
+            self.verified = False
+        return (0x90, self.error_counter)
+
+    def read_security_memory(self):
+        # The PSC itself only reads back after a successful verification
+        psc = self.psc if self.verified else [0x00, 0x00, 0x00]
+        return [self.error_counter] + psc
+
+    def protect(self, address, data):
+        if not self.verified:
+            return SW_SECURITY_NOT_SATISFIED
+        if address + len(data) > self.protectedBytes:
+            return SW_WRONG_PARAMETERS
+        # Protection is only burnt in where the data matches what is already stored
+        for i, byte in enumerate(data):
+            if self.memory[address + i] == byte:
+                self.protection[(address + i) // 8] &= ~(1 << ((address + i) % 8)) & 0xFF
+        return SW_OK
+
+    def change_psc(self, psc):
+        if not self.verified:
+            return SW_SECURITY_NOT_SATISFIED
+        self.psc = list(psc)
+        return SW_OK
+
+
+class SimulatedConnection:
+    """Mimics the subset of pyscard's CardConnection used by the card engine."""
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.card = None
+
+    def getReader(self):
+        return str(self.reader)
+
+    def connect(self):
+        if self.reader.card is None:
+            raise SimulatedCardError(f'No card inserted in {self.reader}')
+        self.card = self.reader.card
+        self.card.reset()
+
+    def disconnect(self):
+        self.card = None
+
+    def check_card(self):
+        if self.card is None or self.reader.card is not self.card:
+            raise SimulatedCardError('Card was removed or reset')
+
+    def getATR(self):
+        self.check_card()
+        return self.card.atr()
+
+    def transmit(self, command):
+        self.check_card()
+        if any(not isinstance(byte, int) or not 0 <= byte <= 0xFF for byte in command):
+            # A real reader driver cannot even encode such an APDU
+            raise SimulatedCardError(f'APDU element out of byte range: {list(command)}')
+        self.reader.transmit_count += 1
+        if self.reader.latency:
+            time.sleep(self.reader.latency)
+        if self.reader.faults:
+            fault = self.reader.faults.pop(0)
+            if isinstance(fault, Exception):
+                raise fault
+            return [], fault[0], fault[1]
+        data, (sw1, sw2) = self.reader.execute(self.card, list(command))
+        return data, sw1, sw2
+
+
+class SimulatedReader:
+    """In-process stand-in for a PC/SC reader returned by smartcard.System.readers()."""
+
+    def __init__(self, name="Simulated Reader 0", card=None, latency=0.0, max_le=256, extended_apdu=False):
+        self.name = name
+        self.latency = latency
+        self.max_le = max_le
+        self.extended_apdu = extended_apdu
+        self.card = None
+        self.transmit_count = 0
+        # Queued failures returned instead of executing the next APDUs: (sw1, sw2) pairs or exceptions to raise
+        self.faults = []
+        self.insert(card)
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return f'SimulatedReader({self.name!r})'
+
+    def createConnection(self):
+        return SimulatedConnection(self)
+
+    def insert(self, card):
+        self.card = card
+        self.selected_type = None
+        self.page_size = 8
+
+    def remove(self):
+        card = self.card
+        self.insert(None)
+        return card
+
+    def execute(self, card, command):
+        if len(command) < 5 or command[0] != 0xFF:
+            return [], SW_INS_NOT_SUPPORTED
+        ins, p1, p2 = command[1], command[2], command[3]
+        body = command[5:5 + command[4]]
+
+        if ins == 0xA4:
+            if not body or body[0] not in card.card_types:
+                return [], SW_WRONG_PARAMETERS
+            self.selected_type = body[0]
+            return [], SW_OK
+        if self.selected_type is None:
+            return [], SW_CONDITIONS_NOT_SATISFIED
+        if ins == 0x01:
+            if not body or body[0] not in PAGE_SIZE_CODES:
+                return [], SW_WRONG_PARAMETERS
+            self.page_size = PAGE_SIZE_CODES[body[0]]
+            return [], SW_OK
+
+        atmel = is_atmel(card.chip_type)
+        address = (p1 << 8) | p2 if atmel else p2
+        if atmel and ins in (0xB1, 0xD1):
+            # The 17th address bit of 1024 kbit cards travels in the low bit of INS
+            ins &= 0xFE
+            address |= 0x10000
+        if ins == 0xB0:
+            length = self.response_length(command)
+            if length is None:
+                return [], SW_WRONG_LENGTH
+            sw, data = card.read(address, length)
+            return data, sw
+        if ins == 0xD0:
+            if len(body) != command[4] or (atmel and len(body) > self.page_size):
+                return [], SW_WRONG_LENGTH
+            return [], card.write(address, body)
+        if atmel:
+            return [], SW_INS_NOT_SUPPORTED
+
+        if ins == 0x20:
+            return [], card.verify(body)
+        if ins == 0xB1:
+            return card.read_security_memory()[:command[4] or 4], SW_OK
+        if ins == 0xB2:
+            return list(card.protection[:command[4] or 4]), SW_OK
+        if ins == 0xD1:
+            return [], card.protect(p2, body)
+        if ins == 0xD2:
+            return [], card.change_psc(body)
+        return [], SW_INS_NOT_SUPPORTED
+
+    def response_length(self, command):
+        if len(command) == 5:
+            length = command[4] or 256
+            return length if length <= self.max_le else None
+        # Extended Le: a zero byte followed by two length bytes
+        if len(command) == 7 and command[4] == 0x00 and self.extended_apdu:
+            return ((command[5] << 8) | command[6]) or 65536
+        return None
+
+
+def make_card(chip_type, **kwargs):
+    if is_atmel(chip_type):
+        return SimulatedAT24Card(chip_type, **kwargs)
+    return SimulatedSLE5542Card(**kwargs)
+
+
+def install(simulated_readers):
+    """Makes the card engine (and everything built on it) see these readers instead of PC/SC."""
+    simulated_readers = list(simulated_readers)
+    set_readers_backend(lambda: list(simulated_readers))
+    return simulated_readers
+
+
+def install_from_environment():
+    """Installs simulated readers described by CARD_SIMULATOR, e.g. "AT24C64,SLE5542".
+
+    CARD_SIMULATOR_LATENCY sets the per-APDU latency in seconds.
+    """
+    chips = os.environ.get('CARD_SIMULATOR')
+    if not chips:
+        return None
+    latency = float(os.environ.get('CARD_SIMULATOR_LATENCY', '0'))
+    return install(SimulatedReader(f'Simulated Reader {i}', make_card(chip.strip()), latency)
+                   for i, chip in enumerate(chips.split(',')))
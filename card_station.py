@@ -0,0 +1,169 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from card_engine import CardEngine
+from card_connection import ReaderConnectionPool
+from card_monitor import CardMonitor
+from card_payload import encode_payload
+from card_save import encode_card, read_json_data
+from card_simulator import install_from_environment
+from card_trace import trace_from_environment
+
+
+class ReaderStats:
+    def __init__(self, reader_name):
+        self.reader_name = reader_name
+        self.encoded = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.started = time.monotonic()
+
+    def cards_per_minute(self):
+        elapsed = time.monotonic() - self.started
+        return self.encoded * 60.0 / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self):
+        return {
+            'reader': self.reader_name,
+            'encoded': self.encoded,
+            'failed': self.failed,
+            'cards_per_minute': round(self.cards_per_minute(), 2),
+            'seconds_per_card': round(self.busy_seconds / self.encoded, 3) if self.encoded else None,
+        }
+
+
+class EncodingStation:
+    """Encodes a queue of user_data JSON files onto cards, with one worker per attached reader.
+
+    Each worker waits for a fresh card in its reader, encodes the next record, verifies it
+    by CRC and then waits for the card to be swapped. A record whose card fails goes back on
+    the queue (up to max_attempts times) so another card or reader can take it.
+    """
+
+    def __init__(self, chip_type="AT24C64", compress=True, verify_pages=False, max_attempts=3,
+                 pool=None, poll_interval=0.2, log=print):
+        self.chip_type = chip_type
+        self.compress = compress
+        self.verify_pages = verify_pages
+        self.max_attempts = max_attempts
+        self.pool = pool or ReaderConnectionPool()
+        self.poll_interval = poll_interval
+        self.log = log
+        self.records = queue.Queue()
+        self.pending = 0
+        self.pendingLock = threading.Lock()
+        self.done = threading.Event()
+        self.results = []
+        self.stats = {}
+
+    def add_files(self, file_paths):
+        for file_path in file_paths:
+            self.records.put((file_path, 1))
+            with self.pendingLock:
+                self.pending += 1
+                self.done.clear()
+
+    def finish_record(self, file_path, success, reader_name, message):
+        self.results.append({'file': file_path, 'reader': reader_name, 'success': success, 'message': message})
+        with self.pendingLock:
+            self.pending -= 1
+            if self.pending == 0:
+                self.done.set()
+
+    def run(self, reader_names=None):
+        """Encodes every queued record and returns the per-reader statistics."""
+        reader_names = reader_names or self.pool.refresh_readers()
+        if not reader_names:
+            raise RuntimeError('No readers attached.')
+        if self.pending == 0:
+            return []
+        # Insert/remove events wake the waiting workers, so encoding starts as soon as a card is in
+        monitor = CardMonitor(self.pool, self.poll_interval).start()
+        workers = []
+        for reader_name in reader_names:
+            self.stats[reader_name] = ReaderStats(reader_name)
+            worker = threading.Thread(target=self.worker, args=(reader_name,), name=f'encode-{reader_name}', daemon=True)
+            worker.start()
+            workers.append(worker)
+        self.done.wait()
+        for worker in workers:
+            worker.join()
+        monitor.stop()
+        return [stats.as_dict() for stats in self.stats.values()]
+
+    def worker(self, reader_name):
+        engine = CardEngine()
+        stats = self.stats[reader_name]
+        usedGeneration = None
+        while not self.done.is_set():
+            # Only take a record once there is a fresh card to put it on
+            generation = self.pool.wait_for_card(reader_name, usedGeneration, poll_interval=self.poll_interval,
+                                                 stop=self.done)
+            if generation is None:
+                return
+            try:
+                file_path, attempt = self.records.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue  # The card stays fresh for the next record
+
+            started = time.monotonic()
+            try:
+                payload = encode_payload(read_json_data(file_path), compress=self.compress)
+            except (OSError, ValueError) as e:
+                # A bad record is not the card's fault, so it is not retried and the card stays fresh
+                self.log(f'[{reader_name}] {file_path} could not be loaded: {str(e)}')
+                self.finish_record(file_path, False, reader_name, f'Error loading record: {str(e)}')
+                continue
+            usedGeneration = generation
+
+            try:
+                result = self.pool.ensure_selected(reader_name, self.chip_type, engine)
+                if result.success:
+                    result = encode_card(engine, payload, self.chip_type, self.verify_pages)
+            except Exception as e:
+                result = None
+                message = f'Error encoding card: {str(e)}'
+            else:
+                message = result.message
+            elapsed = time.monotonic() - started
+
+            if result is not None and result.success:
+                stats.encoded += 1
+                stats.busy_seconds += elapsed
+                self.log(f'[{reader_name}] {file_path} encoded in {elapsed:.2f}s. Please swap the card.')
+                self.finish_record(file_path, True, reader_name, message)
+            else:
+                stats.failed += 1
+                if attempt < self.max_attempts:
+                    self.log(f'[{reader_name}] {file_path} failed ({message}); returning it to the queue.')
+                    self.records.put((file_path, attempt + 1))
+                else:
+                    self.log(f'[{reader_name}] {file_path} failed {attempt} times ({message}); giving up.')
+                    self.finish_record(file_path, False, reader_name, message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Encode user_data JSON files on every attached reader in parallel.')
+    parser.add_argument('files', nargs='+', help='user_data JSON files to encode')
+    parser.add_argument('--chip', default='AT24C64', help='chip type of the blank cards')
+    parser.add_argument('--no-compress', action='store_true', help='store the payload uncompressed')
+    parser.add_argument('--verify-pages', action='store_true', help='read back every page right after writing it')
+    parser.add_argument('--max-attempts', type=int, default=3, help='cards to try per record before giving up')
+    args = parser.parse_args()
+
+    install_from_environment()
+    tracer = trace_from_environment()
+    station = EncodingStation(args.chip, not args.no_compress, args.verify_pages, args.max_attempts)
+    station.add_files(args.files)
+    started = time.monotonic()
+    stats = station.run()
+    output = {'seconds': round(time.monotonic() - started, 3), 'readers': stats, 'records': station.results}
+    if tracer is not None:
+        output['apdu'] = tracer.histograms()
+    print(json.dumps(output, indent=4))
+
+
+if __name__ == '__main__':
+    main()
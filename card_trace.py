@@ -0,0 +1,134 @@
+import bisect
+import json
+import os
+import threading
+import time
+from collections import deque
+from card_engine import set_default_tracer
+
+# Operation names by the INS byte of the reader's pseudo-APDUs (CLA 0xFF)
+APDU_OPERATIONS = {
+    0xA4: 'select',
+    0x01: 'page_size',
+    0x20: 'verify_psc',
+    0xB0: 'read_page',
+    0xD0: 'write_page',
+    0xB1: 'read_security_memory',
+    0xB2: 'read_protection_bits',
+    0xD1: 'protect',
+    0xD2: 'change_psc',
+}
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def operation_name(command):
+    if len(command) < 2:
+        return 'unknown'
+    return APDU_OPERATIONS.get(command[1], f'ins_{command[1]:02X}')
+
+
+class OperationStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, record):
+        self.count += 1
+        if record['error'] is not None or record['sw'] != '9000':
+            self.errors += 1
+        self.bytes_out += record['bytes_out']
+        self.bytes_in += record['bytes_in']
+        self.total_seconds += record['seconds']
+        self.max_seconds = max(self.max_seconds, record['seconds'])
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, record['seconds'] * 1000)] += 1
+
+    def as_dict(self):
+        labels = [f'<={bound}ms' for bound in LATENCY_BUCKETS_MS] + [f'>{LATENCY_BUCKETS_MS[-1]}ms']
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'total_ms': round(self.total_seconds * 1000, 3),
+            'mean_ms': round(self.total_seconds * 1000 / self.count, 3) if self.count else None,
+            'max_ms': round(self.max_seconds * 1000, 3),
+            'histogram': {label: n for label, n in zip(labels, self.buckets) if n},
+        }
+
+
+class ApduTracer:
+    """Records every APDU an engine sends: operation, CLA/INS, bytes each way, status word and wall time.
+
+    Per-operation statistics are always kept. The most recent max_records records
+    are kept in memory, and if jsonl_path is given every record is also appended
+    to that file as one JSON line.
+    """
+
+    def __init__(self, jsonl_path=None, max_records=10000):
+        self.lock = threading.Lock()
+        self.records = deque(maxlen=max_records)
+        self.operations = {}
+        self.jsonl_path = jsonl_path
+        self.jsonl = open(jsonl_path, 'a') if jsonl_path else None
+
+    def record(self, reader_name, command, data, sw1, sw2, seconds, error=None):
+        record = {
+            'time': time.time(),
+            'reader': reader_name,
+            'operation': operation_name(command),
+            'cla': f'{command[0]:02X}' if command else None,
+            'ins': f'{command[1]:02X}' if len(command) > 1 else None,
+            'bytes_out': len(command),
+            'bytes_in': len(data) + 2 if error is None else 0,
+            'sw': f'{sw1:02X}{sw2:02X}' if error is None else None,
+            'seconds': seconds,
+            'error': error,
+        }
+        with self.lock:
+            self.records.append(record)
+            self.operations.setdefault(record['operation'], OperationStats()).add(record)
+            if self.jsonl is not None:
+                self.jsonl.write(json.dumps(record) + '\n')
+                self.jsonl.flush()
+
+    def histograms(self):
+        """Returns the per-operation counts, bytes and latency histogram."""
+        with self.lock:
+            return {name: stats.as_dict() for name, stats in sorted(self.operations.items())}
+
+    def dump_jsonl(self, path):
+        """Writes the records still held in memory to path, one JSON object per line."""
+        with self.lock:
+            records = list(self.records)
+        with open(path, 'w') as file:
+            for record in records:
+                file.write(json.dumps(record) + '\n')
+        return len(records)
+
+    def reset(self):
+        with self.lock:
+            self.records.clear()
+            self.operations = {}
+
+    def close(self):
+        with self.lock:
+            if self.jsonl is not None:
+                self.jsonl.close()
+                self.jsonl = None
+
+
+def trace_from_environment():
+    """Traces every engine's APDUs to the JSONL file named by CARD_TRACE, if it is set."""
+    path = os.environ.get('CARD_TRACE')
+    if not path:
+        return None
+    tracer = ApduTracer(path)
+    set_default_tracer(tracer)
+    return tracer
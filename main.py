@@ -2,6 +2,9 @@ from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QPushButton, QLa
 from PyQt5.QtCore import QProcess, Qt, QTimer
 import sys
 
+# The upload step only queues the enrollment; the drainer started below sends it in the background
+SCRIPT_ARGUMENTS = {'upload_info.py': '--spool'}
+
 class MainApp(QWidget):
     def __init__(self):
         super().__init__()
@@ -16,6 +19,10 @@ class MainApp(QWidget):
         self.process.readyReadStandardError.connect(self.handle_stderr)
         self.process.started.connect(self.on_script_start)
         self.process.finished.connect(self.script_finished)
+        self.drainer = QProcess()
+        self.drainer.setProcessChannelMode(QProcess.MergedChannels)
+        self.drainer.readyReadStandardOutput.connect(self.handle_drainer_output)
+        self.drainer.start('python -u upload_spool.py')
         self.initUI()
         self.script_queue = [
             'take_picture.py',
@@ -117,7 +124,7 @@ class MainApp(QWidget):
     def execute_script(self, script_name):
         if self.process.state() == QProcess.NotRunning:
             print(f"Starting script: {script_name}")
-            self.process.start(f'python {script_name}')
+            self.process.start(f'python {script_name} {SCRIPT_ARGUMENTS.get(script_name, "")}'.strip())
         else:
             print("A script is already running")
     
@@ -131,6 +138,19 @@ class MainApp(QWidget):
         output = bytes(self.process.readAllStandardError()).decode("utf8")
         print(output, end='')  # Print to the terminal
 
+    def handle_drainer_output(self):
+        output = bytes(self.drainer.readAllStandardOutput()).decode("utf8")
+        print(output, end='')
+
+    def closeEvent(self, event):
+        # The drainer hands back what it was sending when terminated, so the next start sends it right away;
+        # if it has to be killed, those items are sent again once their lease (a minute) runs out
+        self.drainer.terminate()
+        if not self.drainer.waitForFinished(3000):
+            self.drainer.kill()
+            self.drainer.waitForFinished(1000)
+        super().closeEvent(event)
+
     def auto_run_steps(self):
         self.auto_run_active = True
         if self.script_queue:
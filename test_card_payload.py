@@ -0,0 +1,26 @@
+import json
+from pathlib import Path
+from card_payload import decode_payload, encode_payload, encode_raw, is_payload
+
+
+def user_data():
+    with open(Path(__file__).parent / 'user_data.json', 'r') as file:
+        return json.load(file)
+
+
+def test_round_trip():
+    data = user_data()
+    for compress in (False, True):
+        assert decode_payload(encode_payload(data, compress=compress)) == data
+
+
+def test_empty_list_round_trip():
+    data = user_data()
+    data['fingerprint_images'] = []
+    for compress in (False, True):
+        assert decode_payload(encode_payload(data, compress=compress)) == data
+
+
+def test_text_starting_with_magic_is_not_a_payload():
+    assert not is_payload('SCHOOL card for José'.encode('utf-8'))
+    assert is_payload(encode_raw('SCHOOL card for José'.encode('utf-8')) + b'\xff' * 8)
@@ -0,0 +1,153 @@
+import json
+import random
+import threading
+from pathlib import Path
+from card_cache import CardImageCache
+from card_engine import ATMEL_BANK_SIZE, CardEngine, RetryPolicy
+from card_image import dump_image
+from card_payload import encode_payload
+from card_simulator import SimulatedReader, SimulatedSLE5542Card, make_card
+
+
+def user_data():
+    with open(Path(__file__).parent / 'user_data.json', 'r') as file:
+        return json.load(file)
+
+
+def connect(card, **kwargs):
+    """Returns (reader, engine) for a simulated reader holding the card, with the card type selected."""
+    reader = SimulatedReader('Simulated Reader 0', card, **kwargs)
+    connection = reader.createConnection()
+    connection.connect()
+    engine = CardEngine(connection, retry_policy=RetryPolicy(sleep=lambda seconds: None))
+    engine.psc = list(card.psc) if hasattr(card, 'psc') else None
+    engine.prepare(card.chip_type)
+    return reader, engine
+
+
+def write_read_verify(chip_type, byteOffset, **kwargs):
+    card = make_card(chip_type)
+    reader, engine = connect(card, **kwargs)
+    payload = encode_payload(user_data())
+    written = engine.write(chip_type, byteOffset, payload, len(payload))
+    assert written.success, written.message
+    assert bytes(card.memory[byteOffset:byteOffset + len(payload)]) == payload
+    readBack = engine.read_range(chip_type, byteOffset, len(payload), cached=False)
+    assert bytes(readBack.data) == payload
+    verified = engine.verify_crc(chip_type, byteOffset, payload)
+    assert verified.success, verified.message
+
+
+def test_write_read_verify_at24c64():
+    write_read_verify('AT24C64', 0)
+
+
+def test_write_read_verify_at24c1024_across_banks():
+    # The payload straddles the 64 KB boundary, so both INS encodings are exercised
+    write_read_verify('AT24C1024', ATMEL_BANK_SIZE - 200)
+    write_read_verify('AT24C1024', ATMEL_BANK_SIZE - 200, extended_apdu=True)
+
+
+def test_delta_write_skips_unchanged_pages():
+    card = make_card('AT24C64')
+    reader, engine = connect(card)
+    data = bytearray(random.Random(1).randbytes(1024))
+    assert engine.write('AT24C64', 0, data, len(data)).success
+    data[100] ^= 0xFF
+    data[700] ^= 0xFF
+    writesBefore = card.page_writes
+    written = engine.write('AT24C64', 0, data, len(data), delta=True)
+    assert written.success
+    assert card.page_writes - writesBefore == written.data['pages_written'] == 2
+    assert written.data['pages_skipped'] == 1024 // 32 - 2
+    assert bytes(card.memory[:1024]) == data
+
+
+def test_sle5542_write_skips_protected_bytes():
+    # Bytes 0-7 are protected and keep what the card was issued with
+    card = SimulatedSLE5542Card(protection_bits=(0x00, 0xFF, 0xFF, 0xFF))
+    card.memory[:8] = b'ISSUED!!'
+    reader, engine = connect(card)
+    data = bytes(range(64))
+    written = engine.write('SLE5542', 0, data, len(data))
+    assert written.success, written.message
+    assert written.data['protected_skipped'] == 8
+    assert card.blocked_writes == 0
+    assert bytes(card.memory[:8]) == b'ISSUED!!'
+    assert bytes(card.memory[8:64]) == data[8:]
+
+
+def test_write_resumes_after_persistent_failure():
+    card = make_card('AT24C64')
+    reader, engine = connect(card)
+    data = random.Random(2).randbytes(200)
+
+    def fail_third_page(done, total):
+        # The third page keeps failing through every retry of the engine
+        if done == 64:
+            reader.faults = [(0x64, 0x00)] * engine.retry_policy.max_attempts
+
+    failed = engine.write('AT24C64', 0, data, len(data), progress=fail_third_page)
+    assert not failed.success
+    assert failed.data['resume_offset'] == 64
+    writesBefore = card.page_writes
+    resumed = engine.write('AT24C64', 0, data, len(data), resume_offset=failed.data['resume_offset'])
+    assert resumed.success, resumed.message
+    assert card.page_writes - writesBefore == (200 - 64 + 31) // 32
+    assert bytes(card.memory[:200]) == data
+
+
+def test_page_crossing_write_does_not_poison_the_cache():
+    card = make_card('AT24C64')
+    reader, engine = connect(card)
+    engine.cache = CardImageCache()
+    engine.cache_key = (str(reader), bytes(card.atr()), 1)
+    assert engine.read_atmel(0, 64).success
+    # Runs past the end of the 32-byte page, so the card wraps the last four bytes to its start
+    assert engine.write_atmel(0x1C, bytes(range(1, 9))).success
+    assert bytes(card.memory[:4]) == bytes(range(5, 9))
+    assert engine.read_atmel(0, 64).data == bytes(card.memory[:64])
+    # A write inside one page is still answered from memory afterwards
+    assert engine.write_atmel(0x24, b'\x11\x22').success
+    hits = engine.cache.hits
+    assert engine.read_atmel(0x20, 32).data == bytes(card.memory[0x20:0x40])
+    assert engine.cache.hits == hits + 32
+
+
+def test_resumed_dump_costs_less_than_a_full_dump(tmp_path):
+    card = make_card('AT24C256')
+    card.memory[:] = random.Random(3).randbytes(len(card.memory))
+    reader, engine = connect(card)
+    transmitted = reader.transmit_count
+    assert dump_image(engine, 'AT24C256', str(tmp_path / 'full.bin'), resume=False).success
+    fullDump = reader.transmit_count - transmitted
+
+    cancel = threading.Event()
+    cancelled = dump_image(engine, 'AT24C256', str(tmp_path / 'card.bin'), resume=False, cancel=cancel,
+                           progress=lambda done, total: done >= 0x4EC0 and cancel.set())
+    assert not cancelled.success
+    transmitted = reader.transmit_count
+    resumed = dump_image(engine, 'AT24C256', str(tmp_path / 'card.bin'))
+    assert resumed.success, resumed.message
+    assert 'resumed at' in resumed.message
+    # Less than 40% of the card is left, so re-reading the checkpointed prefix would cost more than this
+    assert reader.transmit_count - transmitted < fullDump // 2
+    assert (tmp_path / 'card.bin').read_bytes() == (tmp_path / 'full.bin').read_bytes() == bytes(card.memory)
+
+
+def test_dump_restarts_on_another_card_with_the_same_atr(tmp_path):
+    card = make_card('AT24C64')
+    card.memory[:] = random.Random(4).randbytes(len(card.memory))
+    reader, engine = connect(card)
+    cancel = threading.Event()
+    dump_image(engine, 'AT24C64', str(tmp_path / 'card.bin'), resume=False, cancel=cancel,
+               progress=lambda done, total: done >= 4096 and cancel.set())
+    other = make_card('AT24C64')
+    other.memory[:] = random.Random(5).randbytes(len(other.memory))
+    reader.insert(other)
+    engine.connection.connect()
+    engine.prepare('AT24C64')
+    dumped = dump_image(engine, 'AT24C64', str(tmp_path / 'card.bin'))
+    assert dumped.success, dumped.message
+    assert 'resumed at' not in dumped.message
+    assert (tmp_path / 'card.bin').read_bytes() == bytes(other.memory)
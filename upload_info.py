@@ -1,13 +1,59 @@
+import argparse
+import hashlib
 import json
+import os
+import time
+import uuid
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from pathlib import Path
 import re
 
 # Assuming the same constants as before for the API endpoints
-FORM_ENDPOINT = 'http://www.oneasysolution.com/terminal.php'
-PROFILE_PICTURE_ENDPOINT = 'http://www.oneasysolution.com/terminal.php'
-PROFILE_VIDEO_ENDPOINT = 'http://www.oneasysolution.com/terminal.php'
-FINGERPRINT_ENDPOINT = 'http://www.oneasysolution.com/terminal.php'
+# UPLOAD_ENDPOINT points everything at another server, e.g. upload_server.py for testing
+ENDPOINT = os.environ.get('UPLOAD_ENDPOINT', 'http://www.oneasysolution.com/terminal.php')
+FORM_ENDPOINT = ENDPOINT
+PROFILE_PICTURE_ENDPOINT = ENDPOINT
+PROFILE_VIDEO_ENDPOINT = ENDPOINT
+FINGERPRINT_ENDPOINT = ENDPOINT
+
+# Every submission goes to the same host, so they share one pool of keep-alive connections
+POOL_SIZE = 4
+# (connect, read) timeouts in seconds
+REQUEST_TIMEOUT = (10, 120)
+# Picture, video and fingerprints are independent once the form is in, so up to this many go at once
+UPLOAD_CONCURRENCY = POOL_SIZE
+# Videos are streamed from disk in blocks of this size instead of being encoded in memory
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# With UPLOAD_RESUMABLE=1 videos are sent in committed chunks (see resumable_upload), which the server must support
+RESUMABLE_VIDEO_UPLOADS = os.environ.get('UPLOAD_RESUMABLE') == '1'
+RESUMABLE_CHUNK_SIZE = 1024 * 1024
+# Connection failures in a row before a resumable upload gives up
+RESUMABLE_ATTEMPTS = 5
+
+session = None
+request_timeout = REQUEST_TIMEOUT
+
+
+def configure_session(pool_size=POOL_SIZE, timeout=REQUEST_TIMEOUT):
+    """Replaces the shared session with one keeping up to pool_size connections alive."""
+    global session, request_timeout
+    if session is not None:
+        session.close()
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    request_timeout = timeout
+    return session
+
+
+def get_session():
+    if session is None:
+        configure_session()
+    return session
+
 
 
 def submit_file(endpoint, action, file_field_name, file_path, additional_payload=None):
@@ -22,11 +68,166 @@ def submit_file(endpoint, action, file_field_name, file_path, additional_payload
 
     payload = {'action': action}
     payload.update(additional_payload)
-    files = {file_field_name: open(file_path, 'rb')}
+    with open(file_path, 'rb') as file:
+        response = get_session().post(endpoint, data=payload, files={file_field_name: file}, timeout=request_timeout)
+    return response.json()
+
+class MultipartStream:
+    """A multipart/form-data body that reads its file from disk as it is sent.
+
+    requests sends any object with read() and __len__() as the request body with
+    a Content-Length, so memory use stays at one chunk whatever the file size.
+    progress(bytes_sent, total_bytes) is called after every chunk.
+    """
+
+    def __init__(self, fields, file_field_name, file_path, chunk_size=UPLOAD_CHUNK_SIZE, progress=None):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        self.chunk_size = chunk_size
+        self.progress = progress
+        head = b''.join(self.field_part(name, value) for name, value in fields.items())
+        head += (f'--{self.boundary}\r\n'
+                 f'Content-Disposition: form-data; name="{file_field_name}"; filename="{Path(file_path).name}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n').encode()
+        tail = f'\r\n--{self.boundary}--\r\n'.encode()
+        self.file = open(file_path, 'rb')
+        self.length = len(head) + os.fstat(self.file.fileno()).st_size + len(tail)
+        self.parts = [head, None, tail]  # None stands for the file
+        self.buffer = b''
+        self.sent = 0
+
+    def field_part(self, name, value):
+        return (f'--{self.boundary}\r\n'
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f'{value}\r\n').encode()
+
+    def __len__(self):
+        return self.length - self.sent
 
-    response = requests.post(endpoint, data=payload, files=files)
+    def next_chunk(self):
+        while self.parts:
+            if self.parts[0] is not None:
+                return self.parts.pop(0)
+            chunk = self.file.read(self.chunk_size)
+            if chunk:
+                return chunk
+            self.parts.pop(0)
+        return b''
+
+    def read(self, size=-1):
+        if not self.buffer:
+            self.buffer = self.next_chunk()
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.sent += len(data)
+        if data and self.progress is not None:
+            self.progress(self.sent, self.length)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def print_progress(item_name, step=25):
+    """Returns a progress callback that prints every step percent."""
+    reported = [-step]
+
+    def progress(sent, total):
+        percent = sent * 100 // total
+        if percent >= reported[0] + step:
+            reported[0] = percent - percent % step
+            print(f"{item_name}: {percent}% of {total} bytes sent")
+    return progress
+
+
+def stream_file(endpoint, action, file_field_name, file_path, additional_payload=None, progress=None):
+    """Like submit_file, but streams the file in UPLOAD_CHUNK_SIZE blocks instead of encoding it in memory."""
+    if not Path(file_path).is_file():
+        print(f"File not found: {file_path}")
+        return None
+
+    payload = {'action': action}
+    payload.update(additional_payload or {})
+    body = MultipartStream(payload, file_field_name, file_path, progress=progress)
+    try:
+        response = get_session().post(endpoint, data=body, headers={'Content-Type': body.content_type},
+                                      timeout=request_timeout)
+    finally:
+        body.close()
     return response.json()
 
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(RESUMABLE_CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def post_action(endpoint, payload, files=None):
+    response = get_session().post(endpoint, data=payload, files=files, timeout=request_timeout)
+    return response.json()
+
+
+def resumable_upload(endpoint, action, file_field_name, file_path, additional_payload=None,
+                     chunk_size=RESUMABLE_CHUNK_SIZE, attempts=RESUMABLE_ATTEMPTS, progress=None):
+    """Sends the file in chunks the server commits one by one, and resumes after the last committed one.
+
+    The protocol (implemented by upload_server.py):
+    uploadStatus returns the committed offset of the upload, uploadChunk appends
+    a chunk if its offset and SHA-256 match, and finally the action itself is
+    posted with the upload_id in place of the file. The upload_id comes from the
+    file's SHA-256, so even an upload cut off by a restart resumes where it stopped.
+    """
+    if not Path(file_path).is_file():
+        print(f"File not found: {file_path}")
+        return None
+
+    size = os.path.getsize(file_path)
+    digest = file_sha256(file_path)
+    upload = {'upload_id': digest[:32], 'size': size, 'sha256': digest, 'field': file_field_name,
+              'filename': Path(file_path).name}
+    failures = 0
+    with open(file_path, 'rb') as file:
+        while True:
+            try:
+                status = post_action(endpoint, {'action': 'uploadStatus', **upload})
+                if not status.get('success'):
+                    return status
+                offset = int(status['offset'])
+                while offset < size:
+                    file.seek(offset)
+                    chunk = file.read(chunk_size)
+                    result = post_action(endpoint, {
+                        'action': 'uploadChunk',
+                        'upload_id': upload['upload_id'],
+                        'offset': offset,
+                        'sha256': hashlib.sha256(chunk).hexdigest()
+                    }, files={'chunk': ('chunk', chunk)})
+                    if not result.get('success'):
+                        # The server reports its committed offset when it refuses a chunk
+                        if 'offset' not in result or failures + 1 >= attempts:
+                            return result
+                        failures += 1
+                        offset = int(result['offset'])
+                        continue
+                    offset = int(result['offset'])
+                    failures = 0
+                    if progress is not None:
+                        progress(offset, size)
+
+                payload = {'action': action, 'upload_id': upload['upload_id'], 'sha256': digest}
+                payload.update(additional_payload or {})
+                return post_action(endpoint, payload)
+            except requests.RequestException as e:
+                failures += 1
+                if failures >= attempts:
+                    raise
+                print(f"Upload of {file_path} interrupted ({str(e)}), resuming.")
+                time.sleep(min(0.5 * 2 ** failures, 30))
+
+
 def submit_profile_picture(data):
     return submit_file(
         PROFILE_PICTURE_ENDPOINT, 
@@ -35,12 +236,21 @@ def submit_profile_picture(data):
         data['profile_picture']
     )
 
-def submit_profile_video(data):
-    return submit_file(
+def submit_profile_video(data, progress=None):
+    if RESUMABLE_VIDEO_UPLOADS:
+        return resumable_upload(
+            PROFILE_VIDEO_ENDPOINT,
+            'submitProfileVideo',
+            'profile_video',
+            data['profile_video'],
+            progress=progress
+        )
+    return stream_file(
         PROFILE_VIDEO_ENDPOINT, 
         'submitProfileVideo', 
         'profile_video', 
-        data['profile_video']
+        data['profile_video'],
+        progress=progress
     )
 
 def extract_finger_number(filename):
@@ -51,26 +261,66 @@ def extract_finger_number(filename):
     else:
         return None  # No digits found
     
-def submit_fingerprints(data):
+def numbered_fingerprints(data):
+    """Returns (finger_number, path) for every fingerprint image whose file name carries its finger number."""
     # Assuming data['fingerprint_images'] contains the list of filenames
-    fingerprints_info = data['fingerprint_images']
-    responses = []
-
-    for fingerprint_path in fingerprints_info:
+    fingerprints = []
+    for fingerprint_path in data['fingerprint_images']:
         finger_number = extract_finger_number(fingerprint_path)
         if finger_number is not None:
-            response = submit_file(
-                FINGERPRINT_ENDPOINT, 
-                'submitFingerprint', 
-                'fingerprint_image', 
-                fingerprint_path,
-                {'finger': finger_number}  # Use the extracted finger number
-            )
-            responses.append(response)
+            fingerprints.append((finger_number, fingerprint_path))
         else:
             print(f"Could not extract finger number from {fingerprint_path}")
+    return fingerprints
 
-    return responses
+def submit_fingerprint(finger_number, fingerprint_path):
+    return submit_file(
+        FINGERPRINT_ENDPOINT, 
+        'submitFingerprint', 
+        'fingerprint_image', 
+        fingerprint_path,
+        {'finger': finger_number}  # Use the extracted finger number
+    )
+
+def submit_fingerprints(data):
+    return [submit_fingerprint(finger_number, fingerprint_path)
+            for finger_number, fingerprint_path in numbered_fingerprints(data)]
+
+def media_uploads(data):
+    """Returns (item_name, submit) pairs for everything uploaded after the form."""
+    uploads = [
+        ("Profile Picture", lambda: submit_profile_picture(data)),
+        ("Profile Video", lambda: submit_profile_video(data, print_progress("Profile Video"))),
+    ]
+    for finger_number, fingerprint_path in numbered_fingerprints(data):
+        uploads.append((
+            f"Fingerprint Image {finger_number}",
+            lambda finger=finger_number, path=fingerprint_path: submit_fingerprint(finger, path)
+        ))
+    return uploads
+
+def timed_upload(item_name, submit):
+    start = time.perf_counter()
+    try:
+        response = submit()
+    except (requests.RequestException, ValueError) as e:
+        # A failed item is reported like a rejected one instead of cancelling the others
+        response = {'success': False, 'error': str(e)}
+    return {'item': item_name, 'response': response, 'seconds': time.perf_counter() - start}
+
+def submit_concurrently(uploads, max_workers=UPLOAD_CONCURRENCY):
+    """Runs the uploads on up to max_workers threads and returns their results in the given order."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(timed_upload, item_name, submit) for item_name, submit in uploads]
+        return [future.result() for future in futures]
+
+def print_upload_summary(results, total_seconds):
+    print("Upload summary:")
+    for result in results:
+        status = "ok" if result['success'] else "failed"
+        print(f"  {result['item']:<24} {status:<7} {result['seconds'] * 1000:8.0f} ms")
+    print(f"  {len(results)} uploads in {total_seconds:.2f}s "
+          f"(sequential total {sum(result['seconds'] for result in results):.2f}s)")
 
 def submit_form(data):
     # Map the gender to the appropriate numeric value
@@ -81,7 +331,7 @@ def submit_form(data):
     payload = data.copy()
     payload['action'] = 'submitForm'
 
-    response = requests.post(FORM_ENDPOINT, data=payload)
+    response = get_session().post(FORM_ENDPOINT, data=payload, timeout=request_timeout)
     print(response)
     return response.json()
 
@@ -91,33 +341,44 @@ def read_json_file(file_path):
     return data
 
 def main():
+    parser = argparse.ArgumentParser(description='Upload the enrollment in user_data.json.')
+    parser.add_argument('--spool', action='store_true',
+                        help='only queue the enrollment in the upload spool; upload_spool.py sends it')
+    args = parser.parse_args()
+
     # Read data from JSON file
     data = read_json_file('user_data.json')
 
+    if args.spool:
+        import upload_spool
+        spool = upload_spool.UploadSpool()
+        enrollment = spool.enqueue_enrollment(data)
+        print(f"Enrollment {enrollment} queued for upload ({spool.outstanding()} items waiting).")
+        spool.close()
+        return
+
     # Submit the form data
     form_response = submit_form(data)
     print(form_response)
-    handle_response(form_response, "Form")
-
-    # Submit the profile picture
-    picture_response = submit_profile_picture(data)
-    handle_response(picture_response, "Profile Picture")
+    if not handle_response(form_response, "Form"):
+        # The media belongs to the submitted form, so there is nothing to attach it to
+        return
 
-   
-    # Submit the profile video
-    video_response = submit_profile_video(data)
-    handle_response(video_response, "Profile Video")
+    # Submit the profile picture, video and fingerprints in parallel
+    start = time.perf_counter()
+    results = submit_concurrently(media_uploads(data))
+    total_seconds = time.perf_counter() - start
 
-    # Submit the fingerprints
-    fingerprint_responses = submit_fingerprints(data)
     # Variable to count successful submissions
     successful_submissions = 0
 
-    for fingerprint_response in fingerprint_responses:
-        # Assuming handle_response processes each response and determines if it was successful
-        if handle_response(fingerprint_response, "Fingerprint Image"):  # Update this condition based on your actual success criteria
+    for result in results:
+        result['success'] = handle_response(result['response'], result['item'])
+        if result['success'] and result['item'].startswith("Fingerprint Image"):
             successful_submissions += 1
 
+    print_upload_summary(results, total_seconds)
+
     # Print the total number of fingerprints submitted
     print(f"Total fingerprints submitted: {successful_submissions}")
     
@@ -0,0 +1,199 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qsl
+
+# Upload ids are hex digests, which also keeps them safe to use as file names
+UPLOAD_ID = re.compile(r'^[0-9a-f]{8,64}$')
+# The submissions upload_info.py makes; each is stored in a directory of its name
+SUBMIT_ACTIONS = {'submitForm', 'submitProfilePicture', 'submitProfileVideo', 'submitFingerprint'}
+
+
+def safe_filename(filename):
+    """Returns the last component of a posted file name, or None if nothing usable is left."""
+    name = Path(filename.replace('\\', '/')).name
+    return name if name not in ('', '.', '..') else None
+
+
+def parse_body(content_type, body):
+    """Returns (fields, files) of a form post, files mapping field name to (filename, bytes)."""
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=HTTP).parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        fields = {}
+        files = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            data = part.get_payload(decode=True) or b''
+            if part.get_filename() is None:
+                fields[name] = data.decode()
+            else:
+                files[name] = (part.get_filename(), data)
+        return fields, files
+    return dict(parse_qsl(body.decode())), {}
+
+
+class UploadStore:
+    """The receiving side of upload_info.py: plain submissions and resumable uploads.
+
+    A resumable upload is kept as <upload_id>.part, whose size is the committed
+    offset, next to <upload_id>.json describing the finished file. Chunks are
+    only appended if they start at the committed offset and match their SHA-256,
+    and are flushed to disk before they are acknowledged. drop_after makes the
+    server cut the connection once, right after that many bytes were committed,
+    to test recovery from an interrupted upload.
+    """
+
+    def __init__(self, directory, drop_after=None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.drop_after = drop_after
+        self.lock = threading.Lock()
+
+    def part_path(self, upload_id):
+        return self.directory / f'{upload_id}.part'
+
+    def meta_path(self, upload_id):
+        return self.directory / f'{upload_id}.json'
+
+    def committed(self, upload_id):
+        path = self.part_path(upload_id)
+        return path.stat().st_size if path.exists() else 0
+
+    def handle(self, fields, files):
+        """Returns the JSON response, or None to drop the connection without one."""
+        action = fields.get('action')
+        upload_id = fields.get('upload_id')
+        if upload_id is not None and not UPLOAD_ID.match(upload_id):
+            return {'success': False, 'error': 'Invalid upload_id.'}
+        if action == 'uploadStatus':
+            return self.upload_status(upload_id, fields)
+        if action == 'uploadChunk':
+            return self.upload_chunk(upload_id, fields, files)
+        if action is None:
+            return {'success': False, 'error': 'No action given.'}
+        if action not in SUBMIT_ACTIONS:
+            return {'success': False, 'error': f'Unknown action {action!r}.'}
+        return self.submit(action, upload_id, fields, files)
+
+    def upload_status(self, upload_id, fields):
+        with self.lock:
+            meta = {'size': int(fields['size']), 'sha256': fields['sha256'], 'field': fields.get('field', 'file'),
+                    'filename': safe_filename(fields.get('filename', '')) or upload_id}
+            self.meta_path(upload_id).write_text(json.dumps(meta))
+            return {'success': True, 'offset': self.committed(upload_id)}
+
+    def upload_chunk(self, upload_id, fields, files):
+        with self.lock:
+            if not self.meta_path(upload_id).exists():
+                return {'success': False, 'error': 'Unknown upload.'}
+            meta = json.loads(self.meta_path(upload_id).read_text())
+            committed = self.committed(upload_id)
+            _, chunk = files.get('chunk', (None, b''))
+            if int(fields['offset']) != committed:
+                return {'success': False, 'error': 'Chunk does not start at the committed offset.', 'offset': committed}
+            if hashlib.sha256(chunk).hexdigest() != fields['sha256']:
+                return {'success': False, 'error': 'Chunk checksum mismatch.', 'offset': committed}
+            if committed + len(chunk) > meta['size']:
+                return {'success': False, 'error': 'Chunk runs past the end of the file.', 'offset': committed}
+            with open(self.part_path(upload_id), 'ab') as file:
+                file.write(chunk)
+                file.flush()
+                os.fsync(file.fileno())
+            committed += len(chunk)
+            if self.drop_after is not None and committed >= self.drop_after:
+                self.drop_after = None
+                return None
+            return {'success': True, 'offset': committed}
+
+    def submit(self, action, upload_id, fields, files):
+        for name, (filename, _) in files.items():
+            if safe_filename(filename) is None:
+                return {'success': False, 'error': f'Invalid file name for {name}.'}
+        target = self.directory / action
+        target.mkdir(exist_ok=True)
+        with self.lock:
+            if upload_id is not None:
+                # The file of a resumable upload takes the place of a posted file field
+                if not self.meta_path(upload_id).exists():
+                    return {'success': False, 'error': 'Unknown upload.'}
+                meta = json.loads(self.meta_path(upload_id).read_text())
+                part = self.part_path(upload_id)
+                if self.committed(upload_id) != meta['size']:
+                    return {'success': False, 'error': 'Upload is incomplete.', 'offset': self.committed(upload_id)}
+                digest = hashlib.sha256()
+                with open(part, 'rb') as file:
+                    for block in iter(lambda: file.read(1024 * 1024), b''):
+                        digest.update(block)
+                if digest.hexdigest() != meta['sha256']:
+                    part.unlink()
+                    return {'success': False, 'error': 'File checksum mismatch, upload discarded.', 'offset': 0}
+                os.replace(part, target / meta['filename'])
+                self.meta_path(upload_id).unlink()
+                fields[meta['field']] = meta['filename']
+            for name, (filename, data) in files.items():
+                filename = safe_filename(filename)
+                (target / filename).write_bytes(data)
+                fields[name] = filename
+            with open(self.directory / 'submissions.jsonl', 'a') as log:
+                log.write(json.dumps({'time': time.time(), **fields}) + '\n')
+        return {'success': True}
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    store = None
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            fields, files = parse_body(self.headers.get('Content-Type', ''), body)
+            response = self.store.handle(fields, files)
+        except (KeyError, ValueError) as e:
+            response = {'success': False, 'error': f'Bad request: {str(e)}'}
+        if response is None:
+            self.close_connection = True
+            return
+        data = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(directory='uploads', host='127.0.0.1', port=8080, drop_after=None):
+    """Starts the server on a background thread and returns it (port 0 picks a free port)."""
+    handler = type('Handler', (UploadHandler,), {'store': UploadStore(directory, drop_after)})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name='upload-server', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the upload endpoint of upload_info.py, '
+                                                 'including resumable uploads.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--directory', default='uploads', help='where submissions and partial uploads are stored')
+    parser.add_argument('--drop-after', type=int, metavar='BYTES',
+                        help='cut the connection once after this many bytes of an upload were committed')
+    args = parser.parse_args()
+
+    server = serve(args.directory, args.host, args.port, args.drop_after)
+    print(f'Serving on http://{args.host}:{server.server_port}/terminal.php, storing uploads in {args.directory}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
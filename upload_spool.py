@@ -0,0 +1,352 @@
+import argparse
+import json
+import os
+import shutil
+import signal
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+import requests
+import upload_info
+
+SPOOL_DATABASE = 'upload_spool.db'
+# Spooled copies of the enrollment's files, since the capture steps overwrite them for the next person
+SPOOL_DIRECTORY = 'upload_spool'
+# Backoff between attempts, in seconds, doubling from BASE_DELAY up to MAX_DELAY
+BASE_DELAY = 2
+MAX_DELAY = 300
+# An unreachable endpoint is retried until it is back; a submission the server rejects this often is given up
+MAX_REJECTIONS = 3
+# Any other failure (e.g. an answer that is not JSON, or a missing spool file) is given up after this many attempts
+MAX_ATTEMPTS = 20
+# A claimed item whose sender died (e.g. the machine lost power) becomes due again after this many seconds;
+# the drainer renews the lease of the items it is sending every third of it
+LEASE_SECONDS = 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS uploads (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    enrollment TEXT NOT NULL,
+    item TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    depends_on INTEGER REFERENCES uploads(id),
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    rejections INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    lease_until REAL,
+    last_error TEXT,
+    created REAL NOT NULL,
+    completed REAL
+)
+'''
+
+DUE = "((u.status = 'pending' AND u.next_attempt <= :now) OR (u.status = 'sending' AND u.lease_until < :now))"
+
+
+def backoff(attempts, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+    return min(base_delay * 2 ** max(attempts - 1, 0), max_delay)
+
+
+class UploadSpool:
+    """Durable queue of the submissions of upload_info.py, kept in SQLite.
+
+    An enrollment is spooled in one transaction as its form plus one item per
+    file, and the files are copied into the spool directory first. Items are
+    claimed with a lease, so several drainers (even in different processes) never
+    send the same item twice at once, and an item whose sender died is sent
+    again once the lease runs out. Media items wait until their form is done.
+    Items that failed for good stay in the database as failed, with their last
+    error, but the spooled files of an enrollment are removed once none of its
+    items is left to send.
+    """
+
+    def __init__(self, path=SPOOL_DATABASE, directory=SPOOL_DIRECTORY, max_rejections=MAX_REJECTIONS,
+                 lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.directory = Path(directory)
+        self.max_rejections = max_rejections
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute(SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            # IMMEDIATE takes the write lock up front, so a claim cannot race another process
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def spool_file(self, enrollment, file_path):
+        if not Path(file_path).is_file():
+            # Spooled anyway, so the failure shows up like it would have on a direct upload
+            return str(file_path)
+        target = self.directory / enrollment / Path(file_path).name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(file_path, target)
+        with open(target, 'rb') as file:
+            os.fsync(file.fileno())
+        return str(target)
+
+    def enqueue_enrollment(self, data):
+        """Spools the form and every file of one user_data record and returns the enrollment id."""
+        enrollment = uuid.uuid4().hex
+        items = [
+            ("Profile Picture", 'profile_picture', {'path': self.spool_file(enrollment, data['profile_picture'])}),
+            ("Profile Video", 'profile_video', {'path': self.spool_file(enrollment, data['profile_video'])}),
+        ]
+        for finger_number, fingerprint_path in upload_info.numbered_fingerprints(data):
+            items.append((f"Fingerprint Image {finger_number}", 'fingerprint',
+                          {'path': self.spool_file(enrollment, fingerprint_path), 'finger': finger_number}))
+
+        now = time.time()
+        with self.transaction() as db:
+            form = db.execute('INSERT INTO uploads (enrollment, item, kind, payload, created) VALUES (?, ?, ?, ?, ?)',
+                              (enrollment, "Form", 'form', json.dumps(data), now)).lastrowid
+            db.executemany('INSERT INTO uploads (enrollment, item, kind, payload, depends_on, created) '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                           [(enrollment, item, kind, json.dumps(payload), form, now) for item, kind, payload in items])
+        return enrollment
+
+    def claim(self):
+        """Returns the next due item as a dict, leased to the caller, or None if nothing is due."""
+        now = time.time()
+        with self.transaction() as db:
+            row = db.execute(f'SELECT u.* FROM uploads u LEFT JOIN uploads d ON d.id = u.depends_on '
+                             f'WHERE {DUE} AND (u.depends_on IS NULL OR d.status = \'done\') '
+                             f'ORDER BY u.id LIMIT 1', {'now': now}).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE uploads SET status = 'sending', lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                       (now + self.lease_seconds, row['id']))
+        item = dict(row)
+        item['payload'] = json.loads(item['payload'])
+        item['attempts'] += 1
+        return item
+
+    def renew(self, ids):
+        """Extends the lease of the given items that are still being sent."""
+        if not ids:
+            return
+        with self.transaction() as db:
+            db.executemany("UPDATE uploads SET lease_until = ? WHERE id = ? AND status = 'sending'",
+                           [(time.time() + self.lease_seconds, item_id) for item_id in ids])
+
+    def release(self, ids):
+        """Makes the given items due again right away, for a sender that stops before it finished them."""
+        with self.transaction() as db:
+            db.executemany("UPDATE uploads SET status = 'pending', lease_until = NULL, next_attempt = 0 "
+                           "WHERE id = ? AND status = 'sending'", [(item_id,) for item_id in ids])
+
+    def remove_if_settled(self, db, enrollment):
+        remaining = db.execute("SELECT COUNT(*) FROM uploads WHERE enrollment = ? AND status IN ('pending', 'sending')",
+                               (enrollment,)).fetchone()[0]
+        if remaining == 0:
+            shutil.rmtree(self.directory / enrollment, ignore_errors=True)
+
+    def mark_done(self, item):
+        with self.transaction() as db:
+            db.execute("UPDATE uploads SET status = 'done', completed = ?, lease_until = NULL, last_error = NULL "
+                       "WHERE id = ?", (time.time(), item['id']))
+            self.remove_if_settled(db, item['enrollment'])
+
+    def mark_retry(self, item, error, rejected=False, limited=True):
+        """Schedules the item again after a backoff; returns False if it was given up instead.
+
+        Rejections are given up after max_rejections; other failures after
+        max_attempts, unless limited is False (the endpoint was unreachable).
+        """
+        rejections = item['rejections'] + (1 if rejected else 0)
+        with self.transaction() as db:
+            if rejections >= self.max_rejections or (limited and item['attempts'] >= self.max_attempts):
+                # Nothing that depends on a failed item can be sent either
+                db.execute("UPDATE uploads SET status = 'failed', rejections = ?, last_error = ?, lease_until = NULL "
+                           "WHERE id = ? OR depends_on = ?", (rejections, error, item['id'], item['id']))
+                self.remove_if_settled(db, item['enrollment'])
+                return False
+            db.execute("UPDATE uploads SET status = 'pending', rejections = ?, last_error = ?, lease_until = NULL, "
+                       "next_attempt = ? WHERE id = ?",
+                       (rejections, error, time.time() + backoff(item['attempts']), item['id']))
+        return True
+
+    def counts(self):
+        """Returns the number of items per status."""
+        with self.lock:
+            rows = self.db.execute('SELECT status, COUNT(*) FROM uploads GROUP BY status').fetchall()
+        return {status: count for status, count in rows}
+
+    def outstanding(self):
+        counts = self.counts()
+        return counts.get('pending', 0) + counts.get('sending', 0)
+
+
+def send_item(item):
+    """Submits one spooled item through upload_info and returns the server's response."""
+    payload = item['payload']
+    if item['kind'] == 'form':
+        return upload_info.submit_form(dict(payload))
+    if item['kind'] == 'profile_picture':
+        return upload_info.submit_profile_picture({'profile_picture': payload['path']})
+    if item['kind'] == 'profile_video':
+        return upload_info.submit_profile_video({'profile_video': payload['path']})
+    return upload_info.submit_fingerprint(payload['finger'], payload['path'])
+
+
+class UploadDrainer:
+    """Sends spooled items on background threads until stopped, retrying failures with backoff.
+
+    Another thread renews the leases of the items being sent, so a long upload
+    is not claimed a second time by another drainer.
+    """
+
+    def __init__(self, spool, workers=upload_info.UPLOAD_CONCURRENCY, poll_interval=1.0, log=print):
+        self.spool = spool
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.log = log
+        self.stopped = threading.Event()
+        self.finished = threading.Event()
+        self.threads = []
+        self.heartbeat = None
+        self.sending = set()
+        self.sending_lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self.run, name=f'upload-drainer-{index}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        self.heartbeat = threading.Thread(target=self.renew_leases, name='upload-drainer-heartbeat', daemon=True)
+        self.heartbeat.start()
+        return self
+
+    def stop(self):
+        """Lets the items being sent finish, then stops."""
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        self.finished.set()
+        self.heartbeat.join()
+        self.threads = []
+
+    def abandon(self):
+        """Stops without waiting for the items being sent, and hands them back to the spool."""
+        self.stopped.set()
+        self.finished.set()
+        with self.sending_lock:
+            ids = list(self.sending)
+        self.spool.release(ids)
+        return ids
+
+    def renew_leases(self):
+        while not self.finished.wait(self.spool.lease_seconds / 3):
+            with self.sending_lock:
+                ids = list(self.sending)
+            try:
+                self.spool.renew(ids)
+            except sqlite3.Error as e:
+                self.log(f'Upload spool: {str(e)}')
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                item = self.spool.claim()
+            except sqlite3.Error as e:
+                self.log(f'Upload spool: {str(e)}')
+                item = None
+            if item is None:
+                self.stopped.wait(self.poll_interval)
+                continue
+            with self.sending_lock:
+                self.sending.add(item['id'])
+            try:
+                self.process(item)
+            finally:
+                with self.sending_lock:
+                    self.sending.discard(item['id'])
+
+    def process(self, item):
+        start = time.perf_counter()
+        try:
+            response = send_item(item)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            # Unreachable endpoint: keep it until the network is back
+            self.spool.mark_retry(item, str(e), limited=False)
+            self.log(f"{item['item']} upload failed (attempt {item['attempts']}), retrying in "
+                     f"{backoff(item['attempts']):.0f}s: {str(e)}")
+            return
+        except (requests.RequestException, ValueError, OSError) as e:
+            # A non-JSON answer (e.g. a proxy's error page) or a broken spool file: retried, but not forever
+            if self.spool.mark_retry(item, str(e)):
+                self.log(f"{item['item']} upload failed (attempt {item['attempts']} of {self.spool.max_attempts}), "
+                         f"retrying in {backoff(item['attempts']):.0f}s: {str(e)}")
+            else:
+                self.failed += 1
+                self.log(f"{item['item']} upload failed for good after {item['attempts']} attempts: {str(e)}")
+            return
+        seconds = time.perf_counter() - start
+        if response and response.get('success'):
+            self.spool.mark_done(item)
+            self.sent += 1
+            self.log(f"{item['item']} submitted successfully ({seconds * 1000:.0f} ms).")
+            return
+        error = response.get('error') if response else "No response received."
+        if self.spool.mark_retry(item, str(error), rejected=True):
+            self.log(f"{item['item']} submission rejected, retrying: {error}")
+        else:
+            self.failed += 1
+            self.log(f"{item['item']} submission failed for good: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send the enrollments spooled by upload_info.py --spool, '
+                                                 'retrying until the endpoint accepts them.')
+    parser.add_argument('--database', default=SPOOL_DATABASE, help='spool database')
+    parser.add_argument('--directory', default=SPOOL_DIRECTORY, help='where spooled files are kept')
+    parser.add_argument('--workers', type=int, default=upload_info.UPLOAD_CONCURRENCY, help='parallel uploads')
+    parser.add_argument('--once', action='store_true', help='exit once nothing is left to send')
+    parser.add_argument('--status', action='store_true', help='print the number of items per status and exit')
+    args = parser.parse_args()
+
+    spool = UploadSpool(args.database, args.directory)
+    if args.status:
+        print(json.dumps(spool.counts(), indent=4))
+        return
+    # main.py stops the drainer by terminating it; handle that like Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    drainer = UploadDrainer(spool, args.workers).start()
+    try:
+        while not (args.once and spool.outstanding() == 0):
+            time.sleep(drainer.poll_interval)
+    except KeyboardInterrupt:
+        # Hand back what is still being sent, so the next start sends it right away instead of after its lease
+        released = drainer.abandon()
+        print(json.dumps({'sent': drainer.sent, 'failed': drainer.failed, 'released': len(released),
+                          'spool': spool.counts()}, indent=4))
+        return
+    drainer.stop()
+    print(json.dumps({'sent': drainer.sent, 'failed': drainer.failed, 'spool': spool.counts()}, indent=4))
+    spool.close()
+
+
+if __name__ == '__main__':
+    main()